@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+import json
+from functools import update_wrapper
+
+from django.contrib.admin.util import unquote
+from django.core.exceptions import PermissionDenied
+from django.db.models.fields import FieldDoesNotExist
+from django.http import Http404, HttpResponse
+
+from .fields import DictionaryField
+from .widgets import KeyValueWidget
+
+
+class HStoreAdminMixin(object):
+    """
+    ModelAdmin mixin which renders DictionaryFields with a paged
+    KeyValueWidget: only the first `hstore_page_size` pairs are rendered,
+    the others can be found through a key search view, and the submitted
+    changes are merged into the stored value.
+
+    The model must use an HStoreManager.
+    """
+    hstore_page_size = 50
+
+    def formfield_for_dbfield(self, db_field, **kwargs):
+        if isinstance(db_field, DictionaryField) and self.hstore_page_size is not None:
+            kwargs['widget'] = KeyValueWidget(
+                page_size=self.hstore_page_size,
+                search_url='hstore/%s/search/' % db_field.name,
+            )
+        return super(HStoreAdminMixin, self).formfield_for_dbfield(db_field, **kwargs)
+
+    def get_form(self, request, obj=None, **kwargs):
+        form = super(HStoreAdminMixin, self).get_form(request, obj, **kwargs)
+        if obj is None:
+            # the search view looks up the pairs of a saved object
+            for field in form.base_fields.values():
+                if isinstance(field.widget, KeyValueWidget):
+                    field.widget.search_url = None
+        return form
+
+    def get_urls(self):
+        from django.conf.urls import patterns, url
+
+        def wrap(view):
+            def wrapper(*args, **kwargs):
+                return self.admin_site.admin_view(view)(*args, **kwargs)
+            return update_wrapper(wrapper, view)
+
+        urlpatterns = patterns('',
+            url(r'^(.+)/hstore/(\w+)/search/$', wrap(self.hstore_search_view)),
+        )
+        return urlpatterns + super(HStoreAdminMixin, self).get_urls()
+
+    def hstore_search_view(self, request, object_id, attr):
+        """
+        Returns, as JSON, the pairs of an hstore field whose key contains
+        the `q` parameter, without loading the whole value.
+        """
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+
+        try:
+            field = self.model._meta.get_field_by_name(attr)[0]
+        except FieldDoesNotExist:
+            raise Http404
+        if not isinstance(field, DictionaryField):
+            raise Http404
+
+        get_queryset = getattr(self, 'get_queryset', None) or self.queryset  # Django < 1.6
+        queryset = get_queryset(request).filter(pk=unquote(object_id))
+        pairs = queryset.hsearch(attr, request.GET.get('q', ''), limit=self.hstore_page_size)
+        pairs = field.get_prep_value(pairs)
+
+        content = json.dumps({'pairs': [[key, pairs[key]] for key in sorted(pairs)]})
+        return HttpResponse(content, content_type='application/json')
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+from django.db import connections
+from django.db.models import AutoField
+
+from .fields import HStoreField
+from .query_utils import managed_transaction
+from . import util
+
+
+_copy_escapes = {
+    ord('\\'): u'\\\\',
+    ord('\t'): u'\\t',
+    ord('\n'): u'\\n',
+    ord('\r'): u'\\r',
+}
+
+COPY_NULL = u'\\N'
+
+
+def _to_text(value):
+    if isinstance(value, util.bytes_type):
+        return value.decode('utf-8')
+    return util.string_type(value)
+
+
+def _quote_hstore(value):
+    return u'"%s"' % _to_text(value).replace(u'\\', u'\\\\').replace(u'"', u'\\"')
+
+
+def serialize_hstore(data):
+    """
+    Returns the hstore text representation of a dictionary.
+    """
+    return u', '.join(u'%s=>%s' % (_quote_hstore(key), u'NULL' if value is None else _quote_hstore(value))
+                      for key, value in data.items())
+
+
+def copy_value(field, value):
+    """
+    Returns a prepared field value encoded for the COPY text format.
+    """
+    if value is None:
+        return COPY_NULL
+    if isinstance(field, HStoreField):
+        value = serialize_hstore(value)
+    elif isinstance(value, bool):
+        value = u't' if value else u'f'
+    elif hasattr(value, 'isoformat'):
+        value = value.isoformat()
+    return _to_text(value).translate(_copy_escapes)
+
+
+class IteratorFile(object):
+    """
+    Read-only file-like object fed by an iterator of byte strings,
+    which lets psycopg2 stream COPY data without building it in memory.
+    """
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = b''
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buffer) < size:
+            try:
+                self._buffer += next(self._chunks)
+            except StopIteration:
+                break
+
+        if size < 0:
+            data, self._buffer = self._buffer, b''
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def readline(self, size=-1):
+        if not self._buffer:
+            return next(self._chunks, b'')
+        return self.read(size if size >= 0 else len(self._buffer))
+
+
+def copy_from(model, objs, using, keep_pk=False):
+    """
+    Inserts the given model instances (or dictionaries of field values)
+    with a single `COPY ... FROM STDIN` statement. `objs` is consumed
+    lazily, so it may be a generator of any length. With `keep_pk`, as
+    when loading fixtures, the values of auto primary keys are copied too
+    and fields are copied raw, without their pre_save (e.g. auto_now).
+
+    Returns the number of inserted rows.
+    """
+    opts = model._meta
+    if opts.parents:
+        raise ValueError("Can't copy rows of a multi-table inherited model")
+
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    fields = [f for f in opts.local_fields if keep_pk or not isinstance(f, AutoField)]
+    sql = 'COPY %s (%s) FROM STDIN' % (qn(opts.db_table), ', '.join(qn(f.column) for f in fields))
+
+    counter = [0]
+
+    def lines():
+        for obj in objs:
+            if isinstance(obj, dict):
+                obj = model(**obj)
+            values = [copy_value(f, f.get_db_prep_save(
+                getattr(obj, f.attname) if keep_pk else f.pre_save(obj, True), connection=connection))
+                for f in fields]
+            counter[0] += 1
+            yield (u'\t'.join(values) + u'\n').encode('utf-8')
+
+    with managed_transaction(using):
+        cursor = connection.cursor()
+        cursor.copy_expert(sql, IteratorFile(lines()))
+
+    return counter[0]
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+import time
+import threading
+from collections import OrderedDict
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from django.conf import settings
+from django.test.signals import setting_changed
+
+
+class LocMemReferenceCache(object):
+    """
+    Bounded in-process cache of resolved references. Least recently
+    used entries are evicted first, and entries expire after `timeout`
+    seconds. Instances are stored pickled, like in django's locmem cache,
+    so callers never share them.
+    """
+    def __init__(self, max_entries=1000, timeout=300):
+        self.max_entries = max_entries
+        self.timeout = timeout
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, references):
+        found, now = {}, time.time()
+        with self._lock:
+            for reference in references:
+                entry = self._entries.pop(reference, None)
+                if entry is None:
+                    continue
+                expires, pickled = entry
+                if expires is not None and expires <= now:
+                    continue
+                self._entries[reference] = entry
+                found[reference] = pickled
+        return dict((reference, pickle.loads(pickled)) for reference, pickled in found.items())
+
+    def set_many(self, instances):
+        expires = None if self.timeout is None else time.time() + self.timeout
+        pickled = dict((reference, pickle.dumps(instance, pickle.HIGHEST_PROTOCOL))
+                       for reference, instance in instances.items())
+        with self._lock:
+            for reference, value in pickled.items():
+                self._entries.pop(reference, None)
+                self._entries[reference] = (expires, value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, reference):
+        with self._lock:
+            self._entries.pop(reference, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class DjangoReferenceCache(object):
+    """
+    Cache of resolved references stored in one of the caches configured
+    in the django CACHES setting.
+    """
+    key_prefix = 'djorm_hstore.reference:'
+
+    def __init__(self, alias='default', timeout=300):
+        from django.core.cache import get_cache
+        self.cache = get_cache(alias)
+        self.timeout = timeout
+
+    def make_key(self, reference):
+        return self.key_prefix + reference
+
+    def get_many(self, references):
+        keys = dict((self.make_key(reference), reference) for reference in references)
+        found = self.cache.get_many(list(keys))
+        return dict((keys[key], instance) for key, instance in found.items())
+
+    def set_many(self, instances):
+        values = dict((self.make_key(reference), instance) for reference, instance in instances.items())
+        self.cache.set_many(values, self.timeout)
+
+    def delete(self, reference):
+        self.cache.delete(self.make_key(reference))
+
+
+_references_cache = None
+
+
+def get_references_cache():
+    """
+    Returns the references cache configured by the
+    DJORM_HSTORE_REFERENCES_CACHE setting, or None if disabled.
+
+    Example settings::
+
+        # in-process LRU cache
+        DJORM_HSTORE_REFERENCES_CACHE = {'MAX_ENTRIES': 1000, 'TIMEOUT': 300}
+
+        # django cache framework
+        DJORM_HSTORE_REFERENCES_CACHE = {'CACHE': 'default', 'TIMEOUT': 300}
+    """
+    global _references_cache
+
+    if _references_cache is None:
+        options = getattr(settings, 'DJORM_HSTORE_REFERENCES_CACHE', None)
+        if not options:
+            return None
+
+        timeout = options.get('TIMEOUT', 300)
+        if 'CACHE' in options:
+            _references_cache = DjangoReferenceCache(options['CACHE'], timeout)
+        else:
+            _references_cache = LocMemReferenceCache(options.get('MAX_ENTRIES', 1000), timeout)
+
+    return _references_cache
+
+
+def reset_references_cache(**kwargs):
+    global _references_cache
+
+    if kwargs.get('setting', 'DJORM_HSTORE_REFERENCES_CACHE') == 'DJORM_HSTORE_REFERENCES_CACHE':
+        _references_cache = None
+
+setting_changed.connect(reset_references_cache)
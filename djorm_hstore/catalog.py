@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+from django.db import connections
+from django.db.backends.util import truncate_name
+
+from .query_utils import managed_transaction
+
+
+CREATE_CATALOG_SQL = """
+CREATE TABLE %(catalog)s (
+    "key" text PRIMARY KEY,
+    "count" bigint NOT NULL DEFAULT 0
+);
+
+CREATE OR REPLACE FUNCTION %(function)s() RETURNS trigger AS $$
+DECLARE
+    k text;
+BEGIN
+    IF TG_OP = 'UPDATE' AND OLD.%(column)s IS NOT DISTINCT FROM NEW.%(column)s THEN
+        RETURN NULL;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') AND OLD.%(column)s IS NOT NULL THEN
+        UPDATE %(catalog)s SET "count" = "count" - 1 WHERE "key" = ANY(akeys(OLD.%(column)s));
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') AND NEW.%(column)s IS NOT NULL THEN
+        FOR k IN SELECT skeys(NEW.%(column)s) LOOP
+            LOOP
+                UPDATE %(catalog)s SET "count" = "count" + 1 WHERE "key" = k;
+                EXIT WHEN FOUND;
+                BEGIN
+                    INSERT INTO %(catalog)s ("key", "count") VALUES (k, 1);
+                    EXIT;
+                EXCEPTION WHEN unique_violation THEN
+                    -- inserted concurrently, retry the update
+                END;
+            END LOOP;
+        END LOOP;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+LOCK TABLE %(table)s IN SHARE ROW EXCLUSIVE MODE;
+
+CREATE TRIGGER %(trigger)s AFTER INSERT OR UPDATE OF %(column)s OR DELETE ON %(table)s
+    FOR EACH ROW EXECUTE PROCEDURE %(function)s();
+
+INSERT INTO %(catalog)s ("key", "count")
+    SELECT "key", count(*) FROM (SELECT skeys(%(column)s) AS "key" FROM %(table)s) AS "_keys"
+    GROUP BY "key";
+"""
+
+DROP_CATALOG_SQL = """
+DROP TRIGGER IF EXISTS %(trigger)s ON %(table)s;
+DROP FUNCTION IF EXISTS %(function)s();
+DROP TABLE IF EXISTS %(catalog)s;
+"""
+
+
+def catalog_names(model, attr, connection):
+    """
+    Returns the quoted names of the objects which maintain the key
+    catalog of the specified hstore field.
+    """
+    qn = connection.ops.quote_name
+    field = model._meta.get_field_by_name(attr)[0]
+    base = '%s_%s_keys' % (model._meta.db_table, field.column)
+    max_length = connection.ops.max_name_length()
+    return {
+        'table': qn(model._meta.db_table),
+        'column': qn(field.column),
+        'catalog': qn(truncate_name(base, max_length)),
+        'function': qn(truncate_name(base + '_update', max_length)),
+        'trigger': qn(truncate_name(base + '_trigger', max_length)),
+    }
+
+
+def install_key_catalog(model, attr, using='default'):
+    """
+    Creates a summary table with the number of rows using each key of
+    the specified hstore field, kept up to date by a trigger.
+    """
+    connection = connections[using]
+    with managed_transaction(using):
+        connection.cursor().execute(CREATE_CATALOG_SQL % catalog_names(model, attr, connection))
+
+
+def uninstall_key_catalog(model, attr, using='default'):
+    """
+    Drops the summary table and trigger created by install_key_catalog.
+    """
+    connection = connections[using]
+    with managed_transaction(using):
+        connection.cursor().execute(DROP_CATALOG_SQL % catalog_names(model, attr, connection))
+
+
+def materialized_key_catalog(model, attr, using='default'):
+    """
+    Reads the key counts maintained by install_key_catalog.
+    """
+    connection = connections[using]
+    cursor = connection.cursor()
+    cursor.execute('SELECT "key", "count" FROM %(catalog)s WHERE "count" > 0'
+                   % catalog_names(model, attr, connection))
+    return dict(cursor.fetchall())
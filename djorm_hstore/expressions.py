@@ -27,10 +27,117 @@ class HstoreExpression(object):
             raise ValueError("Invalid value")
         return expression
 
+    def contains_any(self, value):
+        if not isinstance(value, (list, tuple)):
+            raise ValueError("Invalid value")
+        return SqlExpression(
+            self.field, "?|", list(value)
+        )
+
+    def contained_by(self, value):
+        if not isinstance(value, dict):
+            raise ValueError("Invalid value")
+        return SqlExpression(
+            self.field, "<@", value
+        )
+
     def exact(self, value):
         return SqlExpression(
             self.field, "=", value
         )
 
+    def key(self, key, lookup="exact", value=None, cast=None):
+        return HstoreKeyExpression(
+            self.field, key, lookup, value, cast
+        )
+
     def as_sql(self, qn, queryset):
         raise NotImplementedError
+
+
+FIELD_LOOKUPS = {
+    'contains': 'contains',
+    'contained_by': 'contained_by',
+    'has_key': 'contains',
+    'has_keys': 'contains',
+    'has_any_keys': 'contains_any',
+}
+
+KEY_CASTS = {
+    'int': 'integer',
+    'integer': 'integer',
+    'bigint': 'bigint',
+    'numeric': 'numeric',
+    'decimal': 'numeric',
+    'float': 'double precision',
+    'double precision': 'double precision',
+    'real': 'real',
+    'bool': 'boolean',
+    'boolean': 'boolean',
+    'date': 'date',
+    'time': 'time',
+    'timestamp': 'timestamp',
+    'timestamptz': 'timestamptz',
+    'text': 'text',
+}
+
+KEY_LOOKUPS = {
+    'exact': '= %s',
+    'gt': '> %s',
+    'gte': '>= %s',
+    'lt': '< %s',
+    'lte': '<= %s',
+    'in': '= ANY(%s)',
+    'range': 'BETWEEN %s AND %s',
+    'isnull': None,
+    'contains': 'LIKE %s',
+    'icontains': 'ILIKE %s',
+    'startswith': 'LIKE %s',
+    'istartswith': 'ILIKE %s',
+    'endswith': 'LIKE %s',
+    'iendswith': 'ILIKE %s',
+}
+
+LIKE_PATTERNS = {
+    'contains': '%%%s%%',
+    'icontains': '%%%s%%',
+    'startswith': '%s%%',
+    'istartswith': '%s%%',
+    'endswith': '%%%s',
+    'iendswith': '%%%s',
+}
+
+
+class HstoreKeyExpression(SqlExpression):
+    """
+    Compares the value of a key, optionally cast to another postgresql
+    type, e.g. `(data -> 'price')::integer > 10`.
+    """
+    sql_template = "(%(field)s -> %%s)%(cast)s %(operator)s"
+
+    def __init__(self, field, key, lookup="exact", value=None, cast=None):
+        if lookup not in KEY_LOOKUPS:
+            raise ValueError("Invalid lookup: %s" % lookup)
+        if cast is not None and cast not in KEY_CASTS:
+            raise ValueError("Invalid cast: %s" % cast)
+
+        if lookup == 'isnull':
+            operator, values = ("IS NULL" if value else "IS NOT NULL"), []
+        elif lookup == 'in':
+            operator, values = KEY_LOOKUPS[lookup], [list(value)]
+        elif lookup == 'range':
+            operator, values = KEY_LOOKUPS[lookup], list(value)
+        elif lookup in LIKE_PATTERNS:
+            value = value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            operator, values = KEY_LOOKUPS[lookup], [LIKE_PATTERNS[lookup] % value]
+        else:
+            operator, values = KEY_LOOKUPS[lookup], [value]
+
+        cast = '::%s' % KEY_CASTS[cast] if cast is not None else ''
+        super(HstoreKeyExpression, self).__init__(field, operator, cast=cast)
+        self.key = key
+        self.values = values
+
+    def as_sql(self, qn, queryset):
+        sql, args = super(HstoreKeyExpression, self).as_sql(qn, queryset)
+        return sql, [self.key] + list(args) + self.values
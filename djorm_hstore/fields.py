@@ -1,8 +1,15 @@
 # -*- coding: utf-8 -*-
+import re
 import sys
 import json
+import hashlib
+import threading
+from contextlib import contextmanager
 
 from django.db import models
+from django.db.backends.util import truncate_name
+from django.db.models import signals
+from django.db.models.query_utils import QueryWrapper
 from django.utils.translation import ugettext_lazy as _
 
 from . import forms, util
@@ -19,17 +26,165 @@ class HStoreDictionary(dict):
     """
     A dictionary subclass which implements hstore support.
     """
+    _prepared = None
+    _replaced = False
+
     def __init__(self, value=None, field=None, instance=None, **params):
         super(HStoreDictionary, self).__init__(value, **params)
         self.field = field
         self.instance = instance
+        self._changed_keys = set()
+        self._removed_keys = set()
+
+    def prepared(self):
+        """
+        Returns the dictionary prepared for the database. The result is
+        cached until the dictionary is changed.
+        """
+        if self._prepared is None:
+            encoders = self.field._encoders if self.field is not None else None
+            self._prepared = util.prepare_hstore(self, encoders)
+        return self._prepared
+
+    def _set_keys(self, keys):
+        self._prepared = None
+        self._changed_keys.update(keys)
+        self._removed_keys.difference_update(keys)
+
+    def _delete_keys(self, keys):
+        self._prepared = None
+        self._removed_keys.update(keys)
+        self._changed_keys.difference_update(keys)
+
+    def __setitem__(self, key, value):
+        self._set_keys([key])
+        super(HStoreDictionary, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        super(HStoreDictionary, self).__delitem__(key)
+        self._delete_keys([key])
+
+    def pop(self, key, *args):
+        if key in self:
+            self._delete_keys([key])
+        return super(HStoreDictionary, self).pop(key, *args)
+
+    def popitem(self):
+        key, value = super(HStoreDictionary, self).popitem()
+        self._delete_keys([key])
+        return key, value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self._set_keys([key])
+        return super(HStoreDictionary, self).setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        other = dict(*args, **kwargs)
+        self._set_keys(other)
+        super(HStoreDictionary, self).update(other)
+
+    def clear(self):
+        self._delete_keys(list(self.keys()))
+        super(HStoreDictionary, self).clear()
+
+    def has_changes(self):
+        return self._replaced or bool(self._changed_keys or self._removed_keys)
+
+    def reset_changes(self):
+        """
+        Forgets the changes made since the dictionary was loaded.
+        """
+        self._replaced = False
+        self._changed_keys = set()
+        self._removed_keys = set()
 
-    def remove(self, keys):
+    def delta(self):
         """
-        Removes the specified keys from this dictionary.
+        Returns an expression which applies the changes made since the
+        dictionary was loaded to the stored value, or None if the whole
+        value has been replaced (or the dictionary has been unpickled).
         """
+        if self._replaced or self.field is None:
+            return None
+
+        sql, params = '"%s"' % self.field.column, []
+        if self._removed_keys:
+            sql = '(%s - %%s::text[])' % sql
+            params.append(list(self._removed_keys))
+        if self._changed_keys:
+            changed = dict((key, dict.__getitem__(self, key)) for key in self._changed_keys)
+            sql = '(%s || %%s)' % sql
+            params.append(self.field.get_prep_value(changed))
+        return QueryWrapper(sql, params)
+
+    def save_changes(self):
+        """
+        Writes only the keys changed since the dictionary was loaded.
+        """
+        if not self.has_changes():
+            return 0
+
+        delta = self.delta()
         queryset = self.instance._base_manager.get_query_set()
-        queryset.filter(pk=self.instance.pk).hremove(self.field.name, keys)
+        rows = queryset.filter(pk=self.instance.pk).update(**{
+            self.field.name: self if delta is None else delta
+        })
+        self.reset_changes()
+        return rows
+
+    def flush(self):
+        """
+        Writes the changes queued by remove() and merge(), together with
+        any other change, in a single statement.
+        """
+        return self.save_changes()
+
+    def _immediate(self, immediate):
+        if immediate is None:
+            return self.field.immediate_updates
+        return immediate
+
+    def _queryset(self):
+        queryset = self.instance._base_manager.get_query_set()
+        return queryset.filter(pk=self.instance.pk)
+
+    def remove(self, keys, immediate=None):
+        """
+        Removes the specified keys from this dictionary. The removal is
+        written by save() or flush() or, with `immediate` (which defaults
+        to the immediate_updates option of the field), right away.
+        """
+        keys = [keys] if isinstance(keys, util.basestring) else list(keys)
+        if self._immediate(immediate):
+            self._queryset().hremove(self.field.name, keys)
+            self._prepared = None
+            self._changed_keys.difference_update(keys)
+        else:
+            self._delete_keys(keys)
+        self._drop(keys)
+
+    def merge(self, updates, immediate=None):
+        """
+        Sets the specified key/value pairs in this dictionary. They are
+        written by save() or flush() or, with `immediate`, right away.
+        """
+        updates = dict(updates)
+        if self._immediate(immediate):
+            self._queryset().hupdate(self.field.name, self.field.get_prep_value(updates))
+            self._prepared = None
+            self._changed_keys.difference_update(updates)
+            self._removed_keys.difference_update(updates)
+            self._store(updates)
+        else:
+            self.update(updates)
+
+    def _drop(self, keys):
+        for key in keys:
+            dict.pop(self, key, None)
+
+    def _store(self, updates):
+        dict.update(self, updates)
 
     def __getstate__(self):
         """
@@ -37,13 +192,31 @@ class HStoreDictionary(dict):
         """
         return dict(self)
 
+    def __reduce__(self):
+        """
+        Rebuilds the dictionary through __init__, so that the change
+        tracking is set up before the items are restored. The field and
+        the instance are not pickled.
+        """
+        return (self.__class__, (self.__getstate__(),))
+
+    def __setstate__(self, state):
+        """
+        Items are restored by pickle itself, the field and the instance
+        are not pickled.
+        """
+        self.field = self.instance = None
+        self.reset_changes()
+
 
 class HStoreDescriptor(models.fields.subclassing.Creator):
     def __set__(self, obj, value):
+        replaced = self.field.name in obj.__dict__
         value = self.field.to_python(value)
 
         if isinstance(value, dict):
             value = self.field._attribute_class(value, self.field, obj)
+            value._replaced = replaced
 
         obj.__dict__[self.field.name] = value
 
@@ -56,47 +229,346 @@ class HStoreDescriptor(models.fields.subclassing.Creator):
         return to_pickle
 
 
+_deferred = threading.local()
+
+
+@contextmanager
+def deferred_references(fields):
+    """
+    Keeps the specified references fields from resolving their values
+    while instances are built, so they can be resolved in bulk later.
+    """
+    previous = getattr(_deferred, 'fields', frozenset())
+    _deferred.fields = previous | frozenset(fields)
+    try:
+        yield
+    finally:
+        _deferred.fields = previous
+
+
+class LazyReferencesDictionary(HStoreDictionary):
+    """
+    A references dictionary which keeps the serialized references and
+    resolves each of them on first access. Full iteration over values
+    resolves all pending references at once.
+    """
+    _unresolved = frozenset()
+
+    def __init__(self, value=None, field=None, instance=None, **params):
+        super(LazyReferencesDictionary, self).__init__(value, field, instance, **params)
+        self._unresolved = set(key for key, reference in dict.items(self)
+                               if isinstance(reference, util.basestring))
+
+    def resolve(self):
+        """
+        Resolves all pending references, with a single query per
+        referenced model.
+        """
+        resolve_references([self])
+
+    def serialized(self):
+        """
+        Returns the serialized references without resolving them.
+        """
+        return util.serialize_references(dict(dict.items(self)))
+
+    def _discard(self, key):
+        if key in self._unresolved:
+            self._unresolved.discard(key)
+
+    def __getitem__(self, key):
+        if key in self._unresolved:
+            reference = dict.__getitem__(self, key)
+            dict.__setitem__(self, key, util.acquire_reference(reference))
+            self._discard(key)
+        return dict.__getitem__(self, key)
+
+    def __setitem__(self, key, value):
+        self._discard(key)
+        super(LazyReferencesDictionary, self).__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self._discard(key)
+        super(LazyReferencesDictionary, self).__delitem__(key)
+
+    def _drop(self, keys):
+        for key in keys:
+            self._discard(key)
+        super(LazyReferencesDictionary, self)._drop(keys)
+
+    def _store(self, updates):
+        for key in updates:
+            self._discard(key)
+        super(LazyReferencesDictionary, self)._store(updates)
+
+    # Overriding __iter__ keeps dict() and ** from copying the serialized
+    # references; they call keys() and then look up each key instead.
+    def __iter__(self):
+        return dict.__iter__(self)
+
+    def keys(self):
+        self.resolve()
+        return dict.keys(self)
+
+    def __eq__(self, other):
+        self.resolve()
+        return dict.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        self.resolve()
+        return dict.__repr__(self)
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def setdefault(self, key, default=None):
+        if key in self:
+            return self[key]
+        self[key] = default
+        return default
+
+    def pop(self, key, *args):
+        if key in self:
+            value = self[key]
+            del self[key]
+            return value
+        return dict.pop(self, key, *args)
+
+    def popitem(self):
+        if not self:
+            return dict.popitem(self)
+        key = next(iter(self))
+        return key, self.pop(key)
+
+    def update(self, *args, **kwargs):
+        other = dict(*args, **kwargs)
+        for key in other:
+            self._discard(key)
+        super(LazyReferencesDictionary, self).update(other)
+
+    def clear(self):
+        self._unresolved = set()
+        super(LazyReferencesDictionary, self).clear()
+
+    def copy(self):
+        self.resolve()
+        return dict(dict.items(self))
+
+    def items(self):
+        self.resolve()
+        return dict.items(self)
+
+    def values(self):
+        self.resolve()
+        return dict.values(self)
+
+    if sys.version_info[0] < 3:
+        def iteritems(self):
+            self.resolve()
+            return dict.iteritems(self)
+
+        def itervalues(self):
+            self.resolve()
+            return dict.itervalues(self)
+
+        def viewitems(self):
+            self.resolve()
+            return dict.viewitems(self)
+
+        def viewvalues(self):
+            self.resolve()
+            return dict.viewvalues(self)
+
+    def __getstate__(self):
+        self.resolve()
+        return super(LazyReferencesDictionary, self).__getstate__()
+
+
+def resolve_references(dictionaries):
+    """
+    Resolves the pending references of several lazy dictionaries at once,
+    with a single query per referenced model.
+    """
+    pending = {}
+    for index, dictionary in enumerate(dictionaries):
+        for key in dictionary._unresolved:
+            pending[(index, key)] = dict.__getitem__(dictionary, key)
+
+    if not pending:
+        return
+
+    resolved = util.acquire_references(pending)
+    for (index, key), instance in resolved.items():
+        dictionary = dictionaries[index]
+        dict.__setitem__(dictionary, key, instance)
+        dictionary._discard(key)
+
+
+class ReferencesDescriptor(HStoreDescriptor):
+    def __set__(self, obj, value):
+        deferred = self.field in getattr(_deferred, 'fields', ())
+        # Python 2 copies dict subclasses from their storage, which would
+        # leak serialized references: only deferred (prefetched) values,
+        # resolved before they are returned, are lazy there.
+        lazy = self.field.lazy and sys.version_info[0] > 2
+        if (lazy or deferred) and isinstance(value, dict):
+            replaced = self.field.name in obj.__dict__
+            obj.__dict__[self.field.name] = LazyReferencesDictionary(value, self.field, obj)
+            obj.__dict__[self.field.name]._replaced = replaced
+            return
+        super(ReferencesDescriptor, self).__set__(obj, value)
+
+
 class HStoreField(models.Field):
     _attribute_class = HStoreDictionary
     _descriptor_class = HStoreDescriptor
+    _encoders = None
+
+    index_types = ('gin', 'gist')
 
     def __init__(self, *args, **kwargs):
+        self.index_type = kwargs.pop('index_type', None)
+        self.key_indexes = tuple(kwargs.pop('key_indexes', ()))
+        self.delta_save = kwargs.pop('delta_save', False)
+        self.immediate_updates = kwargs.pop('immediate_updates', False)
+        if self.index_type is not None and self.index_type not in self.index_types:
+            raise ValueError("Invalid index type: %s" % self.index_type)
         super(HStoreField, self).__init__(*args, **kwargs)
 
+    def _index_names(self, connection):
+        max_length = connection.ops.max_name_length()
+        base = '%s_%s' % (self.model._meta.db_table, self.column)
+        names = []
+        if self.index_type is not None:
+            names.append((truncate_name('%s_%s' % (base, self.index_type), max_length), None))
+        for key in self.key_indexes:
+            suffix = re.sub(r'\W', '_', key)
+            if suffix != key:
+                suffix += '_' + hashlib.md5(key.encode('utf-8')).hexdigest()[:4]
+            names.append((truncate_name('%s_%s_key' % (base, suffix), max_length), key))
+        return names
+
+    def sql_create_indexes(self, connection, exclude=()):
+        """
+        Returns the statements which create the indexes requested with
+        the `index_type` and `key_indexes` options, except those whose
+        name is in `exclude`.
+        """
+        qn = connection.ops.quote_name
+        table, column = qn(self.model._meta.db_table), qn(self.column)
+        statements = []
+        for name, key in self._index_names(connection):
+            if name in exclude:
+                continue
+            if key is None:
+                statements.append('CREATE INDEX %s ON %s USING %s (%s);' % (
+                    qn(name), table, self.index_type, column))
+            else:
+                expression = "%s -> '%s'" % (column, key.replace("'", "''"))
+                cast = self.key_cast(key)
+                if cast not in (None, 'text'):
+                    expression = '(%s)::%s' % (expression, cast)
+                statements.append('CREATE INDEX %s ON %s ((%s));' % (qn(name), table, expression))
+        return statements
+
+    def key_cast(self, key):
+        """
+        Returns the postgresql type the values of the specified key are
+        cast to in lookups and key indexes, or None.
+        """
+        return None
+
+    def sql_drop_indexes(self, connection):
+        """
+        Returns the statements which drop the indexes created by
+        sql_create_indexes.
+        """
+        qn = connection.ops.quote_name
+        return ['DROP INDEX IF EXISTS %s;' % qn(name) for name, key in self._index_names(connection)]
+
     def contribute_to_class(self, cls, name):
         super(HStoreField, self).contribute_to_class(cls, name)
         setattr(cls, self.name, self._descriptor_class(self))
+        signals.post_save.connect(self._reset_changes, sender=cls, weak=False)
+
+    def _reset_changes(self, instance, **kwargs):
+        value = instance.__dict__.get(self.name)
+        if isinstance(value, HStoreDictionary):
+            value.reset_changes()
+
+    def pre_save(self, model_instance, add):
+        value = super(HStoreField, self).pre_save(model_instance, add)
+        if self.delta_save and not add and isinstance(value, HStoreDictionary):
+            delta = value.delta()
+            if delta is not None:
+                return delta
+        return value
+
+    def get_db_prep_save(self, value, connection):
+        if isinstance(value, QueryWrapper):
+            return value
+        return super(HStoreField, self).get_db_prep_save(value, connection)
 
     def db_type(self, connection=None):
         return 'hstore'
 
     def get_prep_value(self, data):
-        if not isinstance(data, (dict, HStoreDictionary)):
+        if not isinstance(data, dict):
             return data
-
-        for key in data:
-            if data[key] is None:
-                continue
-            if not isinstance(data[key], (util.string_type, util.bytes_type)):
-                data[key] = util.string_type(data[key])
-
-        return data
+        if isinstance(data, HStoreDictionary):
+            return data.prepared()
+        return util.prepare_hstore(data, self._encoders)
 
 
 class DictionaryField(HStoreField):
     description = _("A python dictionary in a postgresql hstore field.")
 
+    def __init__(self, *args, **kwargs):
+        self.schema = kwargs.pop('schema', None) or {}
+        self._decoders, self._encoders, self._casts = util.compile_schema(self.schema)
+        super(DictionaryField, self).__init__(*args, **kwargs)
+
+    def key_cast(self, key):
+        return self._casts.get(key)
+
     def formfield(self, **params):
         params.setdefault("form_class", forms.DictionaryField)
         return super(DictionaryField, self).formfield(**params)
 
+    def save_form_data(self, instance, data):
+        """
+        Merges the submitted dictionary (or the changes submitted by a
+        paged KeyValueWidget) into the current value, only setting the
+        keys which differ, so that delta saves just write those.
+        """
+        current = getattr(instance, self.attname)
+        if isinstance(data, util.HStoreDelta):
+            if current is not None:
+                data.apply(current)
+                return
+            data = data.apply({})
+        elif isinstance(data, dict) and isinstance(current, HStoreDictionary):
+            prepared = self.get_prep_value(current)
+            for key in set(current) - set(data):
+                del current[key]
+            for key, value in data.items():
+                if key not in prepared or prepared[key] != value:
+                    current[key] = self._value_to_python(value, key)
+            return
+        super(DictionaryField, self).save_form_data(instance, data)
+
     def value_from_object(self, obj):
         """
-        Return a sorted JSON string.
+        Return the dictionary with its values prepared as text.
         """
         value = super(DictionaryField, self).value_from_object(obj)
         if value is not None:
-            return json.dumps(value, sort_keys=True)
+            return dict(self.get_prep_value(value))
 
     def get_prep_lookup(self, lookup, value):
         return value
@@ -107,10 +579,12 @@ class DictionaryField(HStoreField):
 
         if isinstance(value, util.string_type) and value:
             try:
-                return json.loads(value)
+                value = json.loads(value)
             except ValueError:
                 return {}
 
+        if value and self._decoders and isinstance(value, dict):
+            return util.decode_hstore(value, self._decoders)
         return value or {}
 
     def value_to_string(self, obj):
@@ -118,32 +592,52 @@ class DictionaryField(HStoreField):
         prepped = self.get_prep_value(value)
         return json.dumps(prepped)
 
-    def _value_to_python(self, value):
-        return value
+    def _value_to_python(self, value, key=None):
+        decoder = self._decoders.get(key)
+        if decoder is None or value is None:
+            return value
+        return util.decode_hstore({key: value}, {key: decoder})[key]
 
 
 class ReferencesField(HStoreField):
     description = _("A python dictionary of references to model instances in an hstore field.")
+    _descriptor_class = ReferencesDescriptor
+
+    def __init__(self, *args, **kwargs):
+        self.lazy = kwargs.pop('lazy', True)
+        super(ReferencesField, self).__init__(*args, **kwargs)
 
     def formfield(self, **params):
         params.setdefault("form_class", forms.ReferencesField)
         return super(ReferencesField, self).formfield(**params)
 
     def get_prep_lookup(self, lookup, value):
-        return util.serialize_references(value) if isinstance(value, dict) else value
+        return self._serialize(value) if isinstance(value, dict) else value
 
     def get_prep_value(self, value):
-        return util.serialize_references(value) if value else {}
+        return self._serialize(value) if value else {}
 
     def to_python(self, value):
         return util.unserialize_references(value) if value else {}
 
-    def _value_to_python(self, value):
+    def _serialize(self, value):
+        if isinstance(value, LazyReferencesDictionary):
+            return value.serialized()
+        return util.serialize_references(value)
+
+    def _value_to_python(self, value, key=None):
         return util.acquire_reference(value) if value else None
 
 try:
     from south.modelsinspector import add_introspection_rules
-    add_introspection_rules(rules=[], patterns=['djorm_hstore.fields\.DictionaryField'])
-    add_introspection_rules(rules=[], patterns=['djorm_hstore.fields\.ReferencesField'])
+    add_introspection_rules(rules=[((HStoreField,), [], {
+        'index_type': ['index_type', {'default': None}],
+        'key_indexes': ['key_indexes', {'default': ()}],
+        'delta_save': ['delta_save', {'default': False}],
+        'immediate_updates': ['immediate_updates', {'default': False}],
+    })], patterns=['djorm_hstore.fields\.DictionaryField'])
+    add_introspection_rules(rules=[((ReferencesField,), [], {
+        'lazy': ['lazy', {'default': True}],
+    })], patterns=['djorm_hstore.fields\.ReferencesField'])
 except ImportError:
     pass
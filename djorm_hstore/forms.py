@@ -1,3 +1,4 @@
+import django
 from django.forms import Field
 from django.contrib.admin.widgets import AdminTextareaWidget
 from django.core.exceptions import ValidationError
@@ -10,6 +11,8 @@ import json
 
 class JsonMixin(object):
     def to_python(self, value):
+        if isinstance(value, dict):
+            return value
         try:
             if value is not None:
                 return json.loads(value)
@@ -21,20 +24,27 @@ class JsonMixin(object):
     def value_from_datadict(self, data, files, name):
         value = data.get(name, None)
         try:
-            # load/re-dump to sort by key for has_changed comparison
-            value = json.dumps(json.loads(value), sort_keys=True)
+            # parsed once here, compared structurally by has_changed
+            parsed = json.loads(value)
         except (TypeError, ValueError):
-            pass
-        return value
+            return value
+        return parsed if isinstance(parsed, dict) else value
+
+    if django.VERSION < (1, 6):
+        # Django < 1.6 asks widgets, not fields, whether the data changed
+        def _has_changed(self, initial, data):
+            return util.dictionary_changed(initial, data)
 
 
 class DictionaryFieldWidget(JsonMixin, AdminTextareaWidget):
     def render(self, name, value, attrs=None):
         if value:
-            # a DictionaryField (model field) returns a string value via
-            # value_from_object(), load and re-dump for indentation
+            # a DictionaryField (model field) returns a dict value via
+            # value_from_object(), dump it once with indentation
             try:
-                value = json.dumps(json.loads(value), sort_keys=True, indent=2)
+                if not isinstance(value, dict):
+                    value = json.loads(value)
+                value = json.dumps(value, sort_keys=True, indent=2)
             except ValueError:
                 # Skip formatting if value is not valid JSON
                 pass
@@ -59,6 +69,9 @@ class DictionaryField(JsonMixin, Field):
         defaults.update(params)
         super(DictionaryField, self).__init__(**defaults)
 
+    def _has_changed(self, initial, data):
+        return util.dictionary_changed(initial, data)
+
 
 class ReferencesField(JsonMixin, Field):
     """
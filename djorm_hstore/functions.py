@@ -2,6 +2,8 @@
 
 from djorm_expressions.base import SqlFunction
 
+from .expressions import KEY_CASTS
+
 
 class HstoreSlice(SqlFunction):
     """
@@ -39,3 +41,143 @@ class HstoreKeys(SqlFunction):
     """
 
     sql_function = 'akeys'
+
+
+class HstoreEach(SqlFunction):
+    """
+    Obtain the key/value pairs of hstore fields, one row per pair.
+    Pass "key" or "value" to select a single column of the pairs.
+    Usage::
+
+        queryset = SomeModel.objects.annotate_functions(
+            key=HstoreEach("somefield", "key"),
+            value=HstoreEach("somefield", "value"),
+        )
+    """
+
+    sql_function = 'each'
+
+    def __init__(self, field, column=None):
+        super(HstoreEach, self).__init__(field)
+        if column is not None:
+            if column not in ('key', 'value'):
+                raise ValueError("Invalid column: %s" % column)
+            self.sql_template = '(%%(function)s(%%(field)s)).%s' % column
+
+
+class HstoreSvals(SqlFunction):
+    """
+    Obtain the values of hstore fields, one row per value.
+    Usage::
+
+        queryset = SomeModel.objects\
+            .annotate_functions(value=HstoreSvals("somefield"))
+    """
+
+    sql_function = 'svals'
+
+
+class HstoreToArray(SqlFunction):
+    """
+    Obtain hstore fields as flat [key, value, ...] lists.
+    Usage::
+
+        queryset = SomeModel.objects\
+            .annotate_functions(pairs=HstoreToArray("somefield"))
+    """
+
+    sql_function = 'hstore_to_array'
+
+
+class HstoreToMatrix(SqlFunction):
+    """
+    Obtain hstore fields as [[key, value], ...] lists.
+    Usage::
+
+        queryset = SomeModel.objects\
+            .annotate_functions(pairs=HstoreToMatrix("somefield"))
+    """
+
+    sql_function = 'hstore_to_matrix'
+
+
+class HstoreAggregate(SqlFunction):
+    """
+    Base class of the aggregates over the values of a key, which are cast
+    to a numeric type (``numeric`` by default).
+    """
+
+    sql_template = '%(function)s((%(field)s -> %%s)::%(cast)s)'
+
+    def __init__(self, field, key, cast='numeric'):
+        if cast not in KEY_CASTS:
+            raise ValueError("Invalid cast: %s" % cast)
+        super(HstoreAggregate, self).__init__(field, key, cast=KEY_CASTS[cast])
+
+
+class HstoreSum(HstoreAggregate):
+    """
+    Sum of the values of a key.
+    Usage::
+
+        SomeModel.objects.haggregate(total=HstoreSum("data", "qty"))
+    """
+
+    sql_function = 'sum'
+
+
+class HstoreAvg(HstoreAggregate):
+    """
+    Average of the values of a key.
+    """
+
+    sql_function = 'avg'
+
+
+class HstoreMin(HstoreAggregate):
+    """
+    Minimum of the values of a key.
+    """
+
+    sql_function = 'min'
+
+
+class HstoreMax(HstoreAggregate):
+    """
+    Maximum of the values of a key.
+    """
+
+    sql_function = 'max'
+
+
+class HstoreCountKey(SqlFunction):
+    """
+    Number of rows having a key.
+    Usage::
+
+        SomeModel.objects.haggregate(colored=HstoreCountKey("data", "color"))
+    """
+
+    sql_template = 'count(CASE WHEN %(field)s ? %%s THEN 1 END)'
+
+
+class HstoreKeyHistogram(SqlFunction):
+    """
+    Number of rows using each key or, given a key, number of rows for
+    each of its values. Computed with ``each()`` in a grouped query.
+    Usage::
+
+        SomeModel.objects.haggregate(
+            keys=HstoreKeyHistogram("data"),
+            colors=HstoreKeyHistogram("data", "color"),
+        )
+    """
+
+    sql_template = '(each(%(field)s)).key'
+
+    def __init__(self, field, key=None):
+        if key is None:
+            super(HstoreKeyHistogram, self).__init__(field)
+        else:
+            super(HstoreKeyHistogram, self).__init__(field, key)
+            self.sql_template = '%(field)s -> %%s'
@@ -1,18 +1,194 @@
 # -*- coding: utf-8 -*-
 
 import sys
+from contextlib import contextmanager
 
-from django.db.models.sql.constants import SINGLE
+from django.db.models.sql.constants import SINGLE, GET_ITERATOR_CHUNK_SIZE, QUERY_TERMS
+from django.db.models.sql.where import ExtraWhere
+from django.db.models.fields import FieldDoesNotExist
+from django.utils.datastructures import SortedDict
 from django.db.models.query_utils import QueryWrapper
 from django.db.models.query import QuerySet
-from django.db import models
+from django.db import connections, models, DEFAULT_DB_ALIAS
+from django.core.exceptions import ImproperlyConfigured
 
 from djorm_expressions.models import ExpressionQuerySetMixin, ExpressionManagerMixin
+from djorm_expressions.base import AND
 
-from .query_utils import select_query, update_query
+try:
+    from django.db.models.constants import LOOKUP_SEP
+except ImportError:  # Django < 1.6
+    from django.db.models.sql.constants import LOOKUP_SEP
+
+from .expressions import HstoreExpression, HstoreKeyExpression, FIELD_LOOKUPS, KEY_CASTS, KEY_LOOKUPS
+from .fields import HStoreField, DictionaryField, ReferencesField, LazyReferencesDictionary, deferred_references, resolve_references
+from .functions import HstoreKeyHistogram
+from .query_utils import select_query, update_query, bulk_update_query, stream_query
+from . import bulk, catalog, util
+
+
+NUMERIC_CASTS = ('integer', 'bigint', 'numeric', 'real', 'double precision')
+
+
+class HStoreBatch(object):
+    """
+    Queues hupdate and hremove operations on the rows of a queryset, and
+    applies all of them with a single UPDATE statement.
+    """
+    def __init__(self, queryset):
+        self.queryset = queryset
+        self.operations = SortedDict()
+
+    def _queue(self, attr, template, params):
+        self.operations.setdefault(attr, []).append((template, params))
+        return self
+
+    def hupdate(self, attr, updates):
+        field = self.queryset.model._meta.get_field_by_name(attr)[0]
+        return self._queue(attr, '(%s || %%s)', [field.get_prep_value(dict(updates))])
+
+    def hremove(self, attr, keys):
+        return self._queue(attr, 'delete(%s, %%s)', [keys])
+
+    def execute(self):
+        """
+        Runs the queued operations, returning the number of updated rows.
+        """
+        if not self.operations:
+            return 0
+        operations, self.operations = self.operations, SortedDict()
+        return self.queryset._hbatch_update(operations)
 
 
 class HStoreQuerysetMixin(object):
+    _prefetch_references = ()
+
+    def prefetch_references(self, *attrs):
+        """
+        Resolves the specified references fields for all fetched rows
+        at once, with a single query per referenced model.
+        """
+        clone = self._clone()
+        if attrs == (None,):
+            clone._prefetch_references = ()
+            return clone
+
+        fields = []
+        for attr in attrs:
+            field = self.model._meta.get_field_by_name(attr)[0]
+            if not isinstance(field, ReferencesField):
+                raise ValueError("'%s' is not a references field" % attr)
+            fields.append(field)
+
+        clone._prefetch_references = self._prefetch_references + tuple(fields)
+        return clone
+
+    def iterator(self):
+        iterator = super(HStoreQuerysetMixin, self).iterator()
+        if not self._prefetch_references:
+            return iterator
+        return self._iterator_with_references(iterator)
+
+    def _iterator_with_references(self, iterator):
+        while True:
+            chunk = []
+            with deferred_references(self._prefetch_references):
+                for obj in iterator:
+                    chunk.append(obj)
+                    if len(chunk) == GET_ITERATOR_CHUNK_SIZE:
+                        break
+
+            if not chunk:
+                break
+
+            self._resolve_references(chunk)
+            for obj in chunk:
+                yield obj
+
+    def _resolve_references(self, instances):
+        dictionaries = []
+        for obj in instances:
+            for field in self._prefetch_references:
+                value = obj.__dict__.get(field.name)
+                if isinstance(value, LazyReferencesDictionary):
+                    dictionaries.append(value)
+        resolve_references(dictionaries)
+
+    def _filter_or_exclude(self, negate, *args, **kwargs):
+        expressions = []
+        for lookup, value in list(kwargs.items()):
+            expression = self._key_expression(lookup, value)
+            if expression is not None:
+                expressions.append(expression)
+                del kwargs[lookup]
+
+        if not expressions:
+            return super(HStoreQuerysetMixin, self)._filter_or_exclude(negate, *args, **kwargs)
+
+        # exclude() negates all of its conditions together, so the other
+        # conditions are matched in a subquery and negated with the keys
+        matching = None
+        if negate and (args or kwargs):
+            matching = QuerySet(self.model, using=self.db).filter(*args, **kwargs).values_list('pk')
+            args, kwargs = (), {}
+
+        if args or kwargs:
+            clone = super(HStoreQuerysetMixin, self)._filter_or_exclude(negate, *args, **kwargs)
+        else:
+            assert self.query.can_filter(), \
+                "Cannot filter a query once a slice has been taken."
+            clone = self._clone()
+
+        sql, params = AND(*expressions).as_sql(clone.quote_name, clone)
+        if hasattr(sql, 'to_str'):
+            sql = sql.to_str()
+        sql = 'coalesce((%s), false)' % sql
+        if matching is not None:
+            matching_sql, matching_params = matching.query.get_compiler(self.db).as_sql()
+            sql = '%s AND %s IN (%s)' % (sql, self._pk_select({})['_pk'], matching_sql)
+            params = list(params) + list(matching_params)
+        if negate:
+            sql = 'NOT (%s)' % sql
+        clone.query.where.add(ExtraWhere([sql], params), "AND")
+        return clone
+
+    def _key_expression(self, lookup, value):
+        """
+        Builds the expression for hstore operator lookups, such as
+        data__has_any_keys=['a', 'b'], and for lookups on hstore keys,
+        such as data__price__int__gt=10. Returns None for other lookups.
+        """
+        parts = lookup.split(LOOKUP_SEP)
+        if len(parts) < 2:
+            return None
+        try:
+            field = self.model._meta.get_field_by_name(parts[0])[0]
+        except FieldDoesNotExist:
+            return None
+        if not isinstance(field, DictionaryField):
+            return None
+        if len(parts) == 2 and parts[1] in FIELD_LOOKUPS:
+            if isinstance(value, dict):
+                value = field.get_prep_value(value)
+            return getattr(HstoreExpression(field.name), FIELD_LOOKUPS[parts[1]])(value)
+        if len(parts) == 2 and parts[1] in QUERY_TERMS:
+            return None
+
+        parts, lookup_type, cast = parts[1:], 'exact', None
+        if len(parts) > 1 and parts[-1] in KEY_LOOKUPS:
+            lookup_type = parts.pop()
+        if len(parts) > 1 and parts[-1] in KEY_CASTS:
+            cast = parts.pop()
+
+        key = LOOKUP_SEP.join(parts)
+        if cast is None and field.key_cast(key) != 'text':
+            cast = field.key_cast(key)
+        return HstoreKeyExpression(field.name, key, lookup_type, value, cast)
+
+    def _clone(self, klass=None, setup=False, **kwargs):
+        kwargs.setdefault('_prefetch_references', self._prefetch_references)
+        return super(HStoreQuerysetMixin, self)._clone(klass, setup, **kwargs)
+
     @select_query
     def hkeys(self, query, attr):
         """
@@ -31,7 +207,7 @@ class HStoreQuerysetMixin(object):
         result = query.get_compiler(self.db).execute_sql(SINGLE)
         if result and result[0]:
             field = self.model._meta.get_field_by_name(attr)[0]
-            return field._value_to_python(result[0])
+            return field._value_to_python(result[0], key)
 
     @select_query
     def hslice(self, query, attr, keys):
@@ -42,9 +218,165 @@ class HStoreQuerysetMixin(object):
         result = query.get_compiler(self.db).execute_sql(SINGLE)
         if result and result[0]:
             field = self.model._meta.get_field_by_name(attr)[0]
-            return dict((key, field._value_to_python(value)) for key, value in result[0].items())
+            return dict((key, field._value_to_python(value, key)) for key, value in result[0].items())
         return {}
 
+    def stream(self, chunk_size=2000):
+        """
+        Yields the instances of the queryset, reading the rows from a
+        server-side cursor instead of loading all of them at once.
+        """
+        query = self.query
+        if query.select_related or query.deferred_loading[0] or query.extra_select or query.aggregate_select:
+            raise ValueError("stream() doesn't support select_related, deferred fields, extra or annotations")
+
+        for row in stream_query(query, self.db, chunk_size):
+            obj = self.model(*row)
+            obj._state.db = self.db
+            obj._state.adding = False
+            yield obj
+
+    @select_query
+    def hsearch(self, query, attr, term, limit=None):
+        """
+        Returns the key/value pairs of the specified hstore whose key
+        contains `term` (case-insensitively), expanded with each() and
+        filtered server-side, in key order.
+        """
+        query.add_extra(SortedDict([
+            ('_key', '(each("%s")).key' % attr),
+            ('_value', '(each("%s")).value' % attr),
+        ]), None, None, None, None, None)
+        query.clear_ordering(force_empty=True)
+        sql, params = query.get_compiler(self.db).as_sql()
+
+        term = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        sql = 'SELECT "key", "value" FROM (%s) AS "_pairs"("key", "value") ' \
+              'WHERE "key" ILIKE %%s ORDER BY "key"' % sql
+        params = list(params) + ['%%%s%%' % term]
+        if limit is not None:
+            sql += ' LIMIT %s'
+            params.append(limit)
+
+        cursor = connections[self.db].cursor()
+        cursor.execute(sql, params)
+        field = self.model._meta.get_field_by_name(attr)[0]
+        return SortedDict((key, field._value_to_python(value, key)) for key, value in cursor.fetchall())
+
+    @select_query
+    def iter_hkeys(self, query, attr, chunk_size=2000):
+        """
+        Yields (pk, keys) pairs for all rows, streaming them from a
+        server-side cursor.
+        """
+        query.add_extra(self._pk_select({'_': 'akeys("%s")' % attr}), None, None, None, None, None)
+        for pk, keys in stream_query(query, self.db, chunk_size):
+            yield pk, keys or []
+
+    @select_query
+    def iter_hslice(self, query, attr, keys, chunk_size=2000):
+        """
+        Yields (pk, slice) pairs for all rows, streaming them from a
+        server-side cursor.
+        """
+        query.add_extra(self._pk_select({'_': 'slice("%s", %%s)' % attr}), [keys], None, None, None, None)
+        field = self.model._meta.get_field_by_name(attr)[0]
+        for pk, value in stream_query(query, self.db, chunk_size):
+            yield pk, dict((key, field._value_to_python(val, key)) for key, val in (value or {}).items())
+
+    @select_query
+    def iter_heach(self, query, attr, chunk_size=2000):
+        """
+        Yields a (pk, key, value) tuple for each pair of the specified
+        hstore, expanded with each() and streamed from a server-side cursor.
+        """
+        query.add_extra(self._pk_select(SortedDict([
+            ('_key', '(each("%s")).key' % attr),
+            ('_value', '(each("%s")).value' % attr),
+        ])), None, None, None, None, None)
+        field = self.model._meta.get_field_by_name(attr)[0]
+        for pk, key, value in stream_query(query, self.db, chunk_size):
+            yield pk, key, field._value_to_python(value, key)
+
+    @select_query
+    def key_catalog(self, query, attr, materialized=False):
+        """
+        Returns the distinct keys of the specified hstore with the number
+        of rows using each of them, computed server-side. With
+        `materialized`, the counts of the whole table are read from the
+        summary table created by catalog.install_key_catalog; filtered
+        or sliced querysets are still counted from their rows.
+        """
+        if self._is_row_subset(query):
+            return self._pk_subset().key_catalog(attr)
+        if materialized and not query.where:
+            return catalog.materialized_key_catalog(self.model, attr, using=self.db)
+
+        query.add_extra({'_': 'skeys("%s")' % attr}, None, None, None, None, None)
+        query.clear_ordering(force_empty=True)
+        sql, params = query.get_compiler(self.db).as_sql()
+
+        cursor = connections[self.db].cursor()
+        cursor.execute('SELECT "key", count(*) FROM (%s) AS "_keys"("key") GROUP BY "key"' % sql, params)
+        return dict(cursor.fetchall())
+
+    def haggregate(self, **functions):
+        """
+        Computes aggregates over the values of hstore keys server-side,
+        returning a dictionary keyed by the argument names. All the
+        aggregates run in a single query; each HstoreKeyHistogram runs
+        in its own grouped query and results in a {key: count} dictionary.
+        """
+        clone = self._pk_subset() if self._is_row_subset(self.query) else self._clone()
+        query = clone.query
+        select, params, histograms = SortedDict(), [], SortedDict()
+        for alias, function in functions.items():
+            sql, sql_params = function.as_sql(clone.quote_name, clone)
+            if isinstance(function, HstoreKeyHistogram):
+                histograms[alias] = (sql, list(sql_params))
+            else:
+                select[alias] = sql
+                params.extend(sql_params)
+
+        query.default_cols = False
+        query.clear_select_fields()
+        query.clear_ordering(force_empty=True)
+
+        result = {}
+        if select:
+            aggregates = query.clone()
+            aggregates.add_extra(select, params, None, None, None, None)
+            row = aggregates.get_compiler(self.db).execute_sql(SINGLE)
+            result.update(zip(select.keys(), row))
+
+        cursor = connections[self.db].cursor()
+        for alias, (sql, sql_params) in histograms.items():
+            histogram = query.clone()
+            histogram.add_extra({'_': sql}, sql_params, None, None, None, None)
+            sql, sql_params = histogram.get_compiler(self.db).as_sql()
+            cursor.execute('SELECT "value", count(*) FROM (%s) AS "_values"("value") '
+                           'WHERE "value" IS NOT NULL GROUP BY "value"' % sql, sql_params)
+            result[alias] = dict(cursor.fetchall())
+        return result
+
+    def _is_row_subset(self, query):
+        return bool(query.low_mark or query.high_mark is not None or query.distinct)
+
+    def _pk_subset(self):
+        """
+        Returns an unsliced, non-distinct queryset on the rows of this
+        one, selected through a primary key subquery: the hstore functions
+        expand or aggregate rows, so they can't run in a sliced or
+        distinct query.
+        """
+        return self.__class__(self.model, using=self.db).filter(pk__in=self.values('pk'))
+
+    def _pk_select(self, select):
+        opts = self.model._meta
+        result = SortedDict([('_pk', '%s.%s' % (self.quote_name(opts.db_table), self.quote_name(opts.pk.column)))])
+        result.update(select)
+        return result
+
     @update_query
     def hremove(self, query, attr, keys):
         """
@@ -65,6 +397,119 @@ class HStoreQuerysetMixin(object):
         query.add_update_fields([(field, None, value)])
         return query
 
+    @contextmanager
+    def hbatch(self):
+        """
+        Returns a context manager which queues hupdate and hremove calls
+        and, when the block ends without errors, runs all of them in one
+        UPDATE statement::
+
+            with queryset.hbatch() as batch:
+                batch.hupdate('data', {'a': '1'})
+                batch.hremove('data', ['b'])
+        """
+        batch = HStoreBatch(self)
+        yield batch
+        batch.execute()
+
+    @update_query
+    def _hbatch_update(self, query, operations):
+        for attr, queued in operations.items():
+            sql, params = '"%s"' % attr, []
+            for template, operation_params in queued:
+                sql = template % sql
+                params.extend(operation_params)
+            field, model, direct, m2m = self.model._meta.get_field_by_name(attr)
+            query.add_update_fields([(field, None, QueryWrapper(sql, params))])
+        return query
+
+    @update_query
+    def hincrement(self, query, attr, key, delta=1, cast='bigint'):
+        """
+        Atomically adds `delta` to the numeric value of the specified key
+        (missing keys count as 0). `key` may also be a {key: delta}
+        mapping to change several keys at once.
+        """
+        if cast not in NUMERIC_CASTS:
+            raise ValueError("Invalid cast: %s" % cast)
+
+        deltas = key if isinstance(key, dict) else {key: delta}
+        column = 'coalesce("%s", \'\'::hstore)' % attr
+        keys_sql, values_sql, keys_params, values_params = [], [], [], []
+        for k, d in deltas.items():
+            keys_sql.append('%s')
+            keys_params.append(k)
+            values_sql.append("(coalesce(%s -> %%s, '0')::%s + %%s)::text" % (column, cast))
+            values_params.extend([k, d])
+
+        value = QueryWrapper('%s || hstore(ARRAY[%s]::text[], ARRAY[%s]::text[])' % (
+            column, ', '.join(keys_sql), ', '.join(values_sql)), keys_params + values_params)
+        field, model, direct, m2m = self.model._meta.get_field_by_name(attr)
+        query.add_update_fields([(field, None, value)])
+        return query
+
+    def hdecrement(self, attr, key, delta=1, cast='bigint'):
+        """
+        Atomically subtracts `delta` from the numeric value of the
+        specified key.
+        """
+        if isinstance(key, dict):
+            return self.hincrement(attr, dict((k, -d) for k, d in key.items()), cast=cast)
+        return self.hincrement(attr, key, -delta, cast=cast)
+    hdecrement.alters_data = True
+
+    @bulk_update_query
+    def bulk_hupdate(self, connection, attr, updates, batch_size=1000):
+        """
+        Updates the specified hstore of each row with its own set of
+        key/value pairs, given as a {pk: {key: value}} mapping.
+        """
+        field = self.model._meta.get_field_by_name(attr)[0]
+        values = [(pk, field.get_prep_value(dict(value))) for pk, value in updates.items()]
+        return self._bulk_statements(connection, field, values, '%(column)s || %(value)s',
+                                     '(%s, %s::hstore)', batch_size)
+
+    @bulk_update_query
+    def bulk_hremove(self, connection, attr, keys, batch_size=1000):
+        """
+        Removes a different set of keys from the specified hstore of
+        each row, given as a {pk: [key, ...]} mapping.
+        """
+        field = self.model._meta.get_field_by_name(attr)[0]
+        values = [(pk, list(value)) for pk, value in keys.items()]
+        return self._bulk_statements(connection, field, values, 'delete(%(column)s, %(value)s)',
+                                     '(%s, %s::text[])', batch_size)
+
+    def _bulk_statements(self, connection, field, values, expression, row_template, batch_size):
+        qn = connection.ops.quote_name
+        opts = self.model._meta
+        table = qn(opts.db_table)
+        primary_key = '%s.%s' % (table, qn(opts.pk.column))
+
+        filter_sql, filter_params = '', []
+        if self.query.where:
+            subquery = self.values_list('pk', flat=True).query
+            filter_sql, filter_params = subquery.get_compiler(self.db).as_sql()
+            filter_sql = ' AND %s IN (%s)' % (primary_key, filter_sql)
+
+        expression = expression % {
+            'column': '%s.%s' % (table, qn(field.column)),
+            'value': '"_hstore_values"."value"',
+        }
+
+        for start in range(0, len(values), batch_size):
+            batch = values[start:start + batch_size]
+            sql = 'UPDATE %s SET %s = %s FROM (VALUES %s) AS "_hstore_values"("pk", "value") ' \
+                  'WHERE %s = "_hstore_values"."pk"%s' % (
+                      table, qn(field.column), expression,
+                      ', '.join([row_template] * len(batch)), primary_key, filter_sql)
+
+            params = []
+            for pk, value in batch:
+                params.extend([pk, value])
+            params.extend(filter_params)
+            yield sql, params
+
 
 class HStoreQueryset(HStoreQuerysetMixin, ExpressionQuerySetMixin, QuerySet):
     pass
@@ -85,6 +530,52 @@ class HStoreManagerMixin(object):
     def hslice(self, attr, keys, **params):
         return self.get_query_set().hslice(attr, keys)
 
+    def stream(self, **params):
+        return self.get_query_set().stream(**params)
+
+    def hsearch(self, attr, term, **params):
+        return self.get_query_set().hsearch(attr, term, **params)
+
+    def iter_hkeys(self, attr, **params):
+        return self.get_query_set().iter_hkeys(attr, **params)
+
+    def iter_heach(self, attr, **params):
+        return self.get_query_set().iter_heach(attr, **params)
+
+    def key_catalog(self, attr, **params):
+        return self.get_query_set().key_catalog(attr, **params)
+
+    def haggregate(self, **functions):
+        return self.get_query_set().haggregate(**functions)
+
+    def iter_hslice(self, attr, keys, **params):
+        return self.get_query_set().iter_hslice(attr, keys, **params)
+
+    def prefetch_references(self, *attrs):
+        return self.get_query_set().prefetch_references(*attrs)
+
+    def hbatch(self):
+        return self.get_query_set().hbatch()
+
+    def hincrement(self, attr, key, delta=1, **params):
+        return self.get_query_set().hincrement(attr, key, delta, **params)
+
+    def hdecrement(self, attr, key, delta=1, **params):
+        return self.get_query_set().hdecrement(attr, key, delta, **params)
+
+    def bulk_hupdate(self, attr, updates, **params):
+        return self.get_query_set().bulk_hupdate(attr, updates, **params)
+
+    def bulk_hremove(self, attr, keys, **params):
+        return self.get_query_set().bulk_hremove(attr, keys, **params)
+
+    def copy_from(self, objs):
+        """
+        Inserts the given instances or dictionaries of field values
+        streaming them through a single COPY statement.
+        """
+        return bulk.copy_from(self.model, objs, using=self.db)
+
 
 class HStoreManager(HStoreManagerMixin, ExpressionManagerMixin, models.Manager):
     def get_query_set(self):
@@ -92,15 +583,108 @@ class HStoreManager(HStoreManagerMixin, ExpressionManagerMixin, models.Manager):
 
 
 # Signal attaching
-from psycopg2.extras import register_hstore
+from psycopg2.extensions import new_type, new_array_type, register_type, encodings
+from psycopg2.extras import register_hstore, HstoreAdapter
+
+HSTORE_DECODERS = ('psycopg2', 'fast')
+
+_hstore_oids = {}
+
+def _as_tuple(value):
+    if isinstance(value, (list, tuple)):
+        return tuple(value)
+    return (value,) if value else ()
+
+
+def get_hstore_oids(connection):
+    """
+    Returns the (oids, array_oids) of the hstore type in the database,
+    as set in its HSTORE_OIDS option or queried once per database.
+    """
+    settings_dict = connection.settings_dict
+    if settings_dict.get('HSTORE_OIDS'):
+        oid, array_oid = settings_dict['HSTORE_OIDS']
+        return _as_tuple(oid), _as_tuple(array_oid)
+
+    key = (connection.alias, settings_dict['NAME'])
+    if key not in _hstore_oids:
+        _hstore_oids[key] = HstoreAdapter.get_oids(connection.connection)
+    return _hstore_oids[key]
+
 
 def register_hstore_handler(connection, **kwargs):
     if not connection.settings_dict.get('HAS_HSTORE', True):
         return
+    oids, array_oids = get_hstore_oids(connection)
     if sys.version_info[0] < 3:
-        register_hstore(connection.connection, globally=True, unicode=True)
+        register_hstore(connection.connection, globally=True, unicode=True,
+                        oid=oids or None, array_oid=array_oids)
     else:
-        register_hstore(connection.connection, globally=True)
+        register_hstore(connection.connection, globally=True, oid=oids or None, array_oid=array_oids)
+
+
+def _parse_hstore(value, cursor):
+    if sys.version_info[0] < 3 and value is not None:
+        value = value.decode(encodings[cursor.connection.encoding])
+    return util.parse_hstore(value)
+
+
+def register_hstore_decoder(connection, **kwargs):
+    """
+    Replaces the psycopg2 hstore parser of the connection with
+    util.parse_hstore when the database sets HSTORE_DECODER to 'fast'.
+    """
+    settings_dict = connection.settings_dict
+    decoder = settings_dict.get('HSTORE_DECODER', 'psycopg2')
+    if decoder not in HSTORE_DECODERS:
+        raise ImproperlyConfigured("Invalid HSTORE_DECODER: %s" % decoder)
+    if not settings_dict.get('HAS_HSTORE', True) or decoder != 'fast':
+        return
+
+    oids, array_oids = get_hstore_oids(connection)
+    if not oids:
+        return
+    hstore_type = new_type(oids, 'HSTORE', _parse_hstore)
+    register_type(hstore_type, connection.connection)
+    if array_oids:
+        register_type(new_array_type(array_oids, 'HSTOREARRAY', hstore_type), connection.connection)
 
 from djorm_core.models import connection_handler
 connection_handler.attach_handler(register_hstore_handler, vendor="postgresql", unique=True)
+connection_handler.attach_handler(register_hstore_decoder, vendor="postgresql")
+
+
+def create_hstore_indexes(sender, created_models, db=DEFAULT_DB_ALIAS, **kwargs):
+    """
+    Creates the gin/gist and key indexes of hstore fields after syncdb
+    (or an initial south migration) creates their tables.
+
+    post_syncdb is sent once per application with all the created models,
+    and again by flush, so only the models of the sending application are
+    handled and existing indexes are skipped.
+    """
+    connection = connections[db]
+    if connection.vendor != 'postgresql':
+        return
+
+    fields = []
+    app_models = set(models.get_models(sender, include_auto_created=True))
+    for model in created_models:
+        if model in app_models:
+            fields.extend(field for field in model._meta.local_fields if isinstance(field, HStoreField))
+    if not fields:
+        return
+
+    cursor = connection.cursor()
+    cursor.execute("SELECT indexname FROM pg_indexes WHERE schemaname = ANY (current_schemas(false))")
+    existing = set(row[0] for row in cursor.fetchall())
+
+    statements = []
+    for field in fields:
+        statements.extend(field.sql_create_indexes(connection, exclude=existing))
+
+    if statements:
+        for statement in statements:
+            cursor.execute(statement)
+
+models.signals.post_syncdb.connect(create_hstore_indexes)
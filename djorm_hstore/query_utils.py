@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 
-from django.db import transaction
+import uuid
+from contextlib import contextmanager
+
+from django.db import connections, transaction
 from django.db.models.sql.subqueries import UpdateQuery
 
 def select_query(method):
@@ -12,29 +15,93 @@ def select_query(method):
     return selector
 
 
+@contextmanager
+def managed_transaction(using):
+    """
+    Commits the statements executed in the block, entering transaction
+    management if it is not already active.
+    """
+    forced_managed = False
+    if not transaction.is_managed(using=using):
+        transaction.enter_transaction_management(using=using)
+        forced_managed = True
+
+    try:
+        yield
+        if forced_managed:
+            transaction.commit(using=using)
+        else:
+            transaction.commit_unless_managed(using=using)
+    finally:
+        if forced_managed:
+            transaction.leave_transaction_management(using=using)
+
+
 def update_query(method):
     def updater(self, *args, **params):
         self._for_write = True
         temporal_update_query = self.query.clone(UpdateQuery)
         query = method(self, temporal_update_query, *args, **params)
 
-        forced_managed = False
-        if not transaction.is_managed(using=self.db):
-            transaction.enter_transaction_management(using=self.db)
-            forced_managed = True
-
-        try:
+        with managed_transaction(self.db):
             rows = query.get_compiler(self.db).execute_sql(None)
-            if forced_managed:
-                transaction.commit(using=self.db)
-            else:
-                transaction.commit_unless_managed(using=self.db)
-        finally:
-            if forced_managed:
-                transaction.leave_transaction_management(using=self.db)
 
         self._result_cache = None
         return rows
 
     updater.alters_data = True
     return updater
+
+
+def bulk_update_query(method):
+    """
+    Decorates methods which build a sequence of raw UPDATE statements
+    (as `(sql, params)` pairs) and executes all of them in a single
+    transaction, returning the number of affected rows.
+    """
+    def updater(self, *args, **params):
+        self._for_write = True
+        connection = connections[self.db]
+
+        rows = 0
+        with managed_transaction(self.db):
+            cursor = connection.cursor()
+            for sql, sql_params in method(self, connection, *args, **params):
+                cursor.execute(sql, sql_params)
+                rows += cursor.rowcount
+
+        self._result_cache = None
+        return rows
+
+    updater.alters_data = True
+    return updater
+
+
+def stream_query(query, using, chunk_size):
+    """
+    Executes the query through a named (server-side) cursor, yielding
+    its rows while fetching `chunk_size` rows at a time. The statements
+    executed while iterating are committed when the iteration ends, even
+    if the generator is closed early.
+    """
+    connection = connections[using]
+    sql, params = query.get_compiler(using).as_sql()
+
+    with managed_transaction(using):
+        connection.cursor()  # ensures the connection is open
+        cursor = connection.connection.cursor(name='djorm_hstore_%s' % uuid.uuid4().hex)
+        cursor.itersize = chunk_size
+        try:
+            cursor.execute(sql, params)
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        except GeneratorExit:
+            # closed before the end: leave the block normally so that it
+            # commits instead of ending with a pending transaction
+            return
+        finally:
+            cursor.close()
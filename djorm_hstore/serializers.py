@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+JSON lines serializer which writes hstore values as JSON objects, one
+instance per line, so dumps and loads of large tables can be streamed.
+Register it for dumpdata and loaddata with::
+
+    SERIALIZATION_MODULES = {'jsonl': 'djorm_hstore.serializers'}
+"""
+
+import json
+from itertools import groupby
+
+from django.core.management.color import no_style
+from django.core.serializers import base, python
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connections, DEFAULT_DB_ALIAS
+
+try:
+    from django.utils.encoding import smart_text
+except ImportError:  # Django < 1.4.2
+    from django.utils.encoding import smart_unicode as smart_text
+
+from .fields import HStoreField
+from .query_utils import managed_transaction
+from . import bulk, util
+
+
+class Serializer(python.Serializer):
+    """
+    Writes each instance to the stream as soon as it is serialized. The
+    rows of hstore querysets are read from a server-side cursor.
+    """
+    internal_use_only = False
+
+    def serialize(self, queryset, **options):
+        chunk_size = options.pop('chunk_size', 2000)
+        if hasattr(queryset, 'stream'):
+            queryset = queryset.stream(chunk_size=chunk_size)
+        return super(Serializer, self).serialize(queryset, **options)
+
+    def start_serialization(self):
+        self._current = None
+
+    def end_object(self, obj):
+        self.stream.write(json.dumps({
+            'model': smart_text(obj._meta),
+            'pk': smart_text(obj._get_pk_val(), strings_only=True),
+            'fields': self._current,
+        }, cls=DjangoJSONEncoder, sort_keys=True) + '\n')
+        self._current = None
+
+    def handle_field(self, obj, field):
+        if isinstance(field, HStoreField):
+            value = field._get_val_from_obj(obj)
+            self._current[field.name] = None if value is None else field.get_prep_value(value)
+        else:
+            super(Serializer, self).handle_field(obj, field)
+
+    def getvalue(self):
+        if callable(getattr(self.stream, 'getvalue', None)):
+            return self.stream.getvalue()
+
+
+def _read_lines(stream_or_string):
+    if isinstance(stream_or_string, util.bytes_type):
+        stream_or_string = stream_or_string.decode('utf-8')
+    if isinstance(stream_or_string, util.string_type):
+        stream_or_string = stream_or_string.splitlines()
+
+    for line in stream_or_string:
+        if isinstance(line, util.bytes_type):
+            line = line.decode('utf-8')
+        if line.strip():
+            yield json.loads(line)
+
+
+def Deserializer(stream_or_string, **options):
+    """
+    Reads the instances written by Serializer, one line at a time.
+    """
+    try:
+        for obj in python.Deserializer(_read_lines(stream_or_string), **options):
+            yield obj
+    except GeneratorExit:
+        raise
+    except Exception as e:
+        raise base.DeserializationError(e)
+
+
+def dump(queryset, stream, chunk_size=2000):
+    """
+    Writes the instances of the queryset to the stream as JSON lines,
+    reading them from a server-side cursor.
+    """
+    Serializer().serialize(queryset, stream=stream, chunk_size=chunk_size)
+
+
+def load(stream, using=DEFAULT_DB_ALIAS):
+    """
+    Inserts the instances written by Serializer with COPY (one statement
+    per run of instances of the same model), keeping their primary keys,
+    and resets the sequences of the loaded tables. Many-to-many relations
+    are not loaded.
+
+    Returns the number of inserted rows.
+    """
+    rows, loaded = 0, []
+    objects = (deserialized.object for deserialized in Deserializer(stream, using=using))
+    for model, instances in groupby(objects, type):
+        rows += bulk.copy_from(model, instances, using, keep_pk=True)
+        if model not in loaded:
+            loaded.append(model)
+
+    if loaded:
+        connection = connections[using]
+        with managed_transaction(using):
+            cursor = connection.cursor()
+            for sql in connection.ops.sequence_reset_sql(no_style(), loaded):
+                cursor.execute(sql)
+    return rows
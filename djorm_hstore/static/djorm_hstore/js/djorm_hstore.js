@@ -1,29 +1,70 @@
 django.jQuery(function($){
 $(document).ready(function(){
-    $('.add_keyvaluewidget').click(function(e){
-        var $this = $(this),
-            widget_block =$this.closest('.keyvaluewidget'),
-            children = widget_block.children();
-        if (children.length){
-            var new_row = $(children[0]).clone(true),
-                last_row = $(children[children.length - 2]),
-                html = new_row.html(),
-                index = children.length - 1;
+    function add_row(widget_block, key, value){
+        var children = widget_block.children(),
+            index = widget_block.data('next-index') || children.length - 1,
+            new_row = $(children[0]).clone(true),
+            inputs = new_row.find('input');
 
-            for (var i = 0; i < 2; i++) {
-                var id = $(new_row.find('input')[i]).attr('id') + index.toString();
-                $(new_row.find('label')[i]).attr('for', id);
-                $(new_row.find('input')[i]).attr('id', id);
-                $(new_row.find('input')[i]).attr('name',
-                    $(new_row.find('input')[i]).attr('name') + index.toString()
-                );
-            }
-            $(new_row).insertBefore($this.parent()).slideDown();
+        widget_block.data('next-index', index + 1);
+        for (var i = 0; i < 2; i++) {
+            var id = $(inputs[i]).attr('id') + index.toString();
+            $(new_row.find('label')[i]).attr('for', id);
+            $(inputs[i]).attr('id', id);
+            $(inputs[i]).attr('name', $(inputs[i]).attr('name') + index.toString());
+        }
+        if (key !== undefined) {
+            // pair found by a search, submitted as an existing pair
+            var name = $(inputs[0]).attr('name').replace(/_key_(\d+)$/, '_original_$1');
+            $(inputs[0]).val(key);
+            $(inputs[1]).val(value);
+            $('<input type="hidden" class="original_keyvaluewidget">')
+                .attr('name', name).val(key).appendTo(new_row);
+        }
+        $(new_row).insertBefore(widget_block.find('.add_keyvaluewidget').parent()).slideDown();
+    }
+
+    $('.add_keyvaluewidget').click(function(e){
+        var widget_block = $(this).closest('.keyvaluewidget');
+        if (widget_block.children().length){
+            add_row(widget_block);
         }
     });
 
     $('.keyvaluewidget').delegate('.inline-deletelink', 'click', function(){
-        $(this).parent().parent().slideUp(function(){$(this).remove()});
-    })
+        var row = $(this).parent().parent(),
+            original = row.find('.original_keyvaluewidget').val(),
+            removed = row.closest('.keyvaluewidget').find('.removed_keyvaluewidget');
+
+        if (original && removed.length) {
+            var keys = JSON.parse(removed.val() || '[]');
+            keys.push(original);
+            removed.val(JSON.stringify(keys));
+        }
+        row.slideUp(function(){$(this).remove()});
+    });
+
+    $('.search_keyvaluewidget').bind('keyup', function(){
+        var $this = $(this),
+            widget_block = $this.closest('.keyvaluewidget');
+
+        clearTimeout($this.data('timeout'));
+        $this.data('timeout', setTimeout(function(){
+            $.getJSON($this.attr('data-search-url'), {q: $this.val()}, function(data){
+                var shown = {},
+                    removed = JSON.parse(widget_block.find('.removed_keyvaluewidget').val() || '[]');
+
+                widget_block.find('.original_keyvaluewidget').each(function(){
+                    shown[$(this).val()] = true;
+                });
+                $.each(removed, function(i, key){ shown[key] = true; });
+                $.each(data.pairs, function(i, pair){
+                    if (!shown[pair[0]]) {
+                        add_row(widget_block, pair[0], pair[1]);
+                    }
+                });
+            });
+        }, 300));
+    });
 });
 })
@@ -1,15 +1,36 @@
 # -*- coding: utf-8 -*-
 
-from django.db import connections
+import sys
+import copy
+import json
+import pickle
+import datetime
+from decimal import Decimal
+
+from django.db import connections, transaction
+from django.db.models import Q
 from django.db.models.aggregates import Count
-from django.utils.unittest import TestCase
+from django.utils.unittest import TestCase, skipIf
+from django.test import TestCase as DjangoTestCase
+from django.test.utils import override_settings
 from django.core import serializers
+from django.utils import six
 
 from ..functions import HstoreKeys, HstoreSlice, HstorePeek
+from ..functions import HstoreEach, HstoreSvals, HstoreToArray, HstoreToMatrix
+from ..functions import HstoreSum, HstoreAvg, HstoreMax, HstoreCountKey, HstoreKeyHistogram
 from ..expressions import HstoreExpression
+from ..bulk import serialize_hstore
+from ..serializers import dump, load
+from ..cache import LocMemReferenceCache, get_references_cache
+from ..catalog import install_key_catalog, uninstall_key_catalog
+from .. import util
 
-from .models import DataBag, Ref, RefsBag, DataBagNullable
-from .forms import DataBagForm
+from ..fields import DictionaryField
+from ..models import HStoreBatch
+from .models import DataBag, Ref, RefsBag, DataBagNullable, DataBagDelta, TypedBag, StampedBag
+from .forms import DataBagForm, DataBagDeltaForm
+from ..widgets import KeyValueWidget
 
 
 class TestModelForm(TestCase):
@@ -57,6 +78,123 @@ class TestModelForm(TestCase):
         self.assertEqual(form.changed_data, ['data'])
 
 
+    def test_has_changed_structurally(self):
+        self.assertFalse(util.dictionary_changed({'a': '1', 'b': None}, '{"b": null, "a": "1"}'))
+        self.assertFalse(util.dictionary_changed(u'{}', {}))
+        self.assertTrue(util.dictionary_changed({'a': '1'}, {'a': '2'}))
+        self.assertTrue(util.dictionary_changed({'a': '1'}, '{invalid'))
+
+        self.assertFalse(util.dictionary_changed({'a': '1', 'b': '2'}, util.HStoreDelta({'a': '1'})))
+        self.assertFalse(util.dictionary_changed({'a': '1'}, util.HStoreDelta({}, ['c'])))
+        self.assertTrue(util.dictionary_changed({'a': '1'}, util.HStoreDelta({}, ['a'])))
+        self.assertTrue(util.dictionary_changed({'a': '1'}, util.HStoreDelta({'b': '2'})))
+
+    def test_form_sets_only_changed_keys(self):
+        DataBagDelta.objects.all().delete()
+        bag = DataBagDelta.objects.create(name='delta', data={'a': '1', 'b': '2', 'c': '3'})
+        bag = DataBagDelta.objects.get(pk=bag.pk)
+
+        form = DataBagDeltaForm({'name': 'delta', 'data_key_1': 'a', 'data_value_1': '1',
+                                 'data_key_2': 'b', 'data_value_2': '20'}, instance=bag)
+        self.assertEqual(form.initial['data'], {'a': '1', 'b': '2', 'c': '3'})
+        self.assertTrue(form.is_valid())
+        self.assertEqual(form.changed_data, ['data'])
+
+        instance = form.save(commit=False)
+        self.assertEqual(instance.data._changed_keys, set(['b']))
+        self.assertEqual(instance.data._removed_keys, set(['c']))
+        instance.save()
+        self.assertEqual(DataBagDelta.objects.get(pk=bag.pk).data, {'a': '1', 'b': '20'})
+
+
+class TestKeyValueWidget(TestCase):
+    def setUp(self):
+        DataBag.objects.all().delete()
+
+    def test_paged_render(self):
+        widget = KeyValueWidget(page_size=2, search_url='hstore/data/search/')
+        html = widget.render('data', '{"c": "3", "a": "1", "b": "2"}', {'id': 'id_data'})
+        self.assertIn('name="data_key_1" value="a"', html)
+        self.assertIn('name="data_key_2" value="b"', html)
+        self.assertNotIn('value="c"', html)
+        self.assertIn('name="data_original_1" value="a"', html)
+        self.assertIn('name="data_partial"', html)
+        self.assertIn('data-search-url="hstore/data/search/"', html)
+
+    def test_paged_value_from_datadict(self):
+        widget = KeyValueWidget(page_size=2)
+        value = widget.value_from_datadict({
+            'data_partial': '1',
+            'data_removed': '["b"]',
+            'data_key_1': 'a', 'data_value_1': '10', 'data_original_1': 'a',
+            'data_key_3': 'z', 'data_value_3': '5', 'data_original_3': 'c',
+            'data_key_4': 'd', 'data_value_4': '4',
+        }, {}, 'data')
+        self.assertTrue(isinstance(value, util.HStoreDelta))
+        self.assertEqual(value, {'a': '10', 'z': '5', 'd': '4'})
+        self.assertEqual(value.removed, set(['b', 'c']))
+
+    def test_removals_only_delta(self):
+        delta = util.HStoreDelta({}, ['a'])
+        self.assertTrue(delta)
+        self.assertNotEqual(delta, {})
+        self.assertFalse(delta in ({}, None, ''))
+        self.assertEqual(delta, util.HStoreDelta({}, ['a']))
+        self.assertFalse(util.HStoreDelta())
+        self.assertEqual(util.HStoreDelta(), {})
+
+    def test_paged_form_removes_all_shown(self):
+        bag = DataBag.objects.create(name='bag', data={'a': '1', 'b': '2', 'c': '3'})
+        form = DataBagForm({
+            'name': 'bag',
+            'data_partial': '1',
+            'data_removed': '["a", "b"]',
+        }, instance=bag)
+        form.fields['data'].widget = KeyValueWidget(page_size=2)
+        self.assertTrue(form.is_valid())
+        form.save()
+        self.assertEqual(DataBag.objects.get(pk=bag.pk).data, {'c': '3'})
+
+    def test_admin_search_on_change_only(self):
+        from django.contrib.admin import ModelAdmin, AdminSite
+        from django.test.client import RequestFactory
+        from ..admin import HStoreAdminMixin
+
+        class DataBagAdmin(HStoreAdminMixin, ModelAdmin):
+            pass
+
+        model_admin = DataBagAdmin(DataBag, AdminSite())
+        request = RequestFactory().get('/')
+        bag = DataBag.objects.create(name='bag', data={'a': '1'})
+
+        add_widget = model_admin.get_form(request).base_fields['data'].widget
+        change_widget = model_admin.get_form(request, bag).base_fields['data'].widget
+        self.assertEqual(add_widget.search_url, None)
+        self.assertEqual(change_widget.search_url, 'hstore/data/search/')
+        self.assertNotIn('search_keyvaluewidget', add_widget.render('data', '{"a": "1"}', {'id': 'id_data'}))
+
+    def test_paged_form_merges_changes(self):
+        bag = DataBag.objects.create(name='bag', data={'a': '1', 'b': '2', 'c': '3', 'd': '4'})
+        form = DataBagForm({
+            'name': 'bag',
+            'data_partial': '1',
+            'data_removed': '["b"]',
+            'data_key_1': 'a', 'data_value_1': '10', 'data_original_1': 'a',
+            'data_key_2': 'e', 'data_value_2': '5',
+        }, instance=bag)
+        form.fields['data'].widget = KeyValueWidget(page_size=2)
+        self.assertTrue(form.is_valid())
+        form.save()
+        self.assertEqual(DataBag.objects.get(pk=bag.pk).data, {'a': '10', 'c': '3', 'd': '4', 'e': '5'})
+
+    def test_hsearch(self):
+        bag = DataBag.objects.create(name='bag', data={'color': 'red', 'colour': 'blue', 'size': '1', 'c%': '2'})
+        queryset = DataBag.objects.filter(pk=bag.pk)
+        self.assertEqual(list(queryset.hsearch('data', 'COL').items()), [('color', 'red'), ('colour', 'blue')])
+        self.assertEqual(list(queryset.hsearch('data', 'col', limit=1).keys()), ['color'])
+        self.assertEqual(list(queryset.hsearch('data', '%').keys()), ['c%'])
+
+
 class TestDictionaryField(TestCase):
     def setUp(self):
         DataBag.objects.all().delete()
@@ -106,7 +244,116 @@ class TestDictionaryField(TestCase):
             "one": u"1",
             "two": "2",
         }
-        self.assertEqual(expected_data, instance.data)
+        self.assertEqual(expected_data, DataBag.objects.get(pk=instance.pk).data)
+
+        # saving doesn't convert the values of the instance dictionary
+        self.assertEqual(instance.data["one"], 1)
+
+    def test_prep_value_cache(self):
+        field = DataBag._meta.get_field_by_name('data')[0]
+        instance = DataBag(name='numbers', data={'one': 1})
+
+        prepared = field.get_prep_value(instance.data)
+        self.assertEqual(prepared, {'one': u'1'})
+        self.assertTrue(field.get_prep_value(instance.data) is prepared)
+
+        instance.data['two'] = 2
+        self.assertEqual(field.get_prep_value(instance.data), {'one': u'1', 'two': u'2'})
+        self.assertEqual(instance.data, {'one': 1, 'two': 2})
+
+    def test_changed_keys_tracking(self):
+        alpha, beta = self._create_bags()
+        instance = DataBag.objects.get(pk=alpha.pk)
+        self.assertFalse(instance.data.has_changes())
+
+        instance.data['v3'] = '5'
+        instance.data.update(v='2')
+        del instance.data['v2']
+        self.assertEqual(instance.data._changed_keys, set(['v', 'v3']))
+        self.assertEqual(instance.data._removed_keys, set(['v2']))
+
+        instance.save()
+        self.assertFalse(instance.data.has_changes())
+
+    def test_save_changes(self):
+        alpha, beta = self._create_bags()
+        first = DataBag.objects.get(pk=alpha.pk)
+        second = DataBag.objects.get(pk=alpha.pk)
+
+        first.data['v3'] = '3'
+        self.assertEqual(first.data.save_changes(), 1)
+        second.data['v'] = '5'
+        del second.data['v2']
+        self.assertEqual(second.data.save_changes(), 1)
+        self.assertEqual(second.data.save_changes(), 0)
+
+        self.assertEqual(DataBag.objects.get(pk=alpha.pk).data, {'v': '5', 'v3': '3'})
+
+    def test_deferred_remove_and_merge(self):
+        alpha, beta = self._create_bags()
+        instance = DataBag.objects.get(pk=alpha.pk)
+
+        for key in ('v', 'missing'):
+            instance.data.remove(key)
+        instance.data.merge({'v3': '3'})
+        self.assertEqual(instance.data, {'v2': '3', 'v3': '3'})
+        self.assertEqual(DataBag.objects.get(pk=alpha.pk).data, alpha.data)
+
+        self.assertEqual(instance.data.flush(), 1)
+        self.assertEqual(DataBag.objects.get(pk=alpha.pk).data, {'v2': '3', 'v3': '3'})
+        self.assertFalse(instance.data.has_changes())
+
+        instance.data.remove(['v2', 'v3'])
+        instance.save()
+        self.assertEqual(DataBag.objects.get(pk=alpha.pk).data, {})
+
+    def test_immediate_remove_and_merge(self):
+        alpha, beta = self._create_bags()
+        instance = DataBag.objects.get(pk=alpha.pk)
+
+        instance.data.remove('v', immediate=True)
+        instance.data.merge({'v3': '3'}, immediate=True)
+        self.assertEqual(instance.data, {'v2': '3', 'v3': '3'})
+        self.assertFalse(instance.data.has_changes())
+        self.assertEqual(DataBag.objects.get(pk=alpha.pk).data, {'v2': '3', 'v3': '3'})
+
+    def test_pickle(self):
+        DataBagDelta.objects.all().delete()
+        instance = DataBagDelta.objects.create(name='delta', data={'a': '1'})
+        instance.data['b'] = '2'
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            data = pickle.loads(pickle.dumps(instance.data, protocol))
+            self.assertEqual(data, {'a': '1', 'b': '2'})
+            self.assertFalse(data.has_changes())
+            data['c'] = '3'
+        self.assertEqual(copy.copy(instance.data), {'a': '1', 'b': '2'})
+        self.assertEqual(copy.deepcopy(instance.data), {'a': '1', 'b': '2'})
+
+        # an unpickled value has no field, so it is saved whole
+        instance = DataBagDelta.objects.get(pk=instance.pk)
+        data = pickle.loads(pickle.dumps(instance.data, pickle.HIGHEST_PROTOCOL))
+        data['c'] = '3'
+        instance.__dict__['data'] = data
+        instance.save()
+        self.assertEqual(DataBagDelta.objects.get(pk=instance.pk).data, {'a': '1', 'c': '3'})
+
+    def test_delta_save(self):
+        DataBagDelta.objects.all().delete()
+        bag = DataBagDelta.objects.create(name='delta', data={'a': '1', 'b': '2'})
+        first = DataBagDelta.objects.get(pk=bag.pk)
+        second = DataBagDelta.objects.get(pk=bag.pk)
+
+        first.data['c'] = 3
+        first.save()
+        second.data['a'] = '10'
+        second.data.pop('b')
+        second.save()
+        self.assertEqual(DataBagDelta.objects.get(pk=bag.pk).data, {'a': '10', 'c': '3'})
+
+        # replacing the whole dictionary writes the full value
+        second.data = {'d': '4'}
+        second.save()
+        self.assertEqual(DataBagDelta.objects.get(pk=bag.pk).data, {'d': '4'})
 
     def test_named_querying(self):
         alpha, beta = self._create_bags()
@@ -263,6 +510,153 @@ class TestDictionaryField(TestCase):
         self.assertEqual(queryset.hslice(attr='data', keys=['v']), {'v': '1'})
         self.assertEqual(queryset.hslice(attr='data', keys=['invalid']), {})
 
+    def test_iter_hkeys(self):
+        alpha, beta = self._create_bags()
+        result = list(DataBag.objects.order_by('name').iter_hkeys('data', chunk_size=1))
+        self.assertEqual([(pk, sorted(keys)) for pk, keys in result],
+                         [(alpha.pk, ['v', 'v2']), (beta.pk, ['v', 'v2'])])
+
+    def test_iter_hkeys_break(self):
+        alpha, beta = self._create_bags()
+        for pk, keys in DataBag.objects.order_by('name').iter_hkeys('data', chunk_size=1):
+            DataBag.objects.filter(pk=pk).hupdate('data', {'seen': '1'})
+            break
+
+        self.assertFalse(transaction.is_managed())
+        transaction.rollback()
+        self.assertEqual(DataBag.objects.get(pk=alpha.pk).data, dict(alpha.data, seen='1'))
+        self.assertEqual(DataBag.objects.get(pk=beta.pk).data, beta.data)
+
+    def test_iter_hslice(self):
+        alpha, beta = self._create_bags()
+        result = list(DataBag.objects.order_by('name').iter_hslice('data', ['v'], chunk_size=1))
+        self.assertEqual(result, [(alpha.pk, {'v': '1'}), (beta.pk, {'v': '2'})])
+
+        result = list(DataBag.objects.filter(name='beta').iter_hslice('data', ['invalid']))
+        self.assertEqual(result, [(beta.pk, {})])
+
+    def test_iter_heach(self):
+        alpha, beta = self._create_bags()
+        result = list(DataBag.objects.order_by('name').iter_heach('data', chunk_size=1))
+        self.assertEqual(sorted(result), sorted([
+            (alpha.pk, 'v', '1'), (alpha.pk, 'v2', '3'),
+            (beta.pk, 'v', '2'), (beta.pk, 'v2', '4'),
+        ]))
+
+    def test_each_annotations(self):
+        alpha, beta = self._create_bags()
+        queryset = DataBag.objects.filter(name='alpha').annotate_functions(
+            key=HstoreEach("data", "key"), value=HstoreEach("data", "value"))
+        self.assertEqual(sorted((obj.key, obj.value) for obj in queryset), [('v', '1'), ('v2', '3')])
+
+        queryset = DataBag.objects.filter(name='alpha').annotate_functions(value=HstoreSvals("data"))
+        self.assertEqual(sorted(obj.value for obj in queryset), ['1', '3'])
+
+        self.assertRaises(ValueError, HstoreEach, "data", "invalid")
+
+    def test_array_annotations(self):
+        alpha, beta = self._create_bags()
+        queryset = DataBag.objects.filter(name='alpha').annotate_functions(
+            array=HstoreToArray("data"), matrix=HstoreToMatrix("data"))
+        self.assertEqual(sorted(queryset[0].matrix), [['v', '1'], ['v2', '3']])
+        self.assertEqual(sorted(queryset[0].array), ['1', '3', 'v', 'v2'])
+
+    def test_key_catalog(self):
+        self._create_bags()
+        DataBag.objects.create(name='gamma', data={'v': '3', 'v3': '5'})
+        self.assertEqual(DataBag.objects.key_catalog('data'), {'v': 3, 'v2': 2, 'v3': 1})
+        self.assertEqual(DataBag.objects.filter(name='gamma').key_catalog('data'), {'v': 1, 'v3': 1})
+        self.assertEqual(DataBag.objects.order_by('name')[1:].key_catalog('data'), {'v': 2, 'v2': 1, 'v3': 1})
+
+    def test_haggregate(self):
+        DataBag.objects.create(name='alpha', data={'qty': '2', 'color': 'red'})
+        DataBag.objects.create(name='beta', data={'qty': '3', 'color': 'red'})
+        DataBag.objects.create(name='gamma', data={'color': 'blue'})
+
+        result = DataBag.objects.haggregate(
+            total=HstoreSum('data', 'qty'),
+            average=HstoreAvg('data', 'qty', cast='float'),
+            top=HstoreMax('data', 'qty', cast='int'),
+            counted=HstoreCountKey('data', 'qty'),
+        )
+        self.assertEqual(result, {'total': Decimal('5'), 'average': 2.5, 'top': 3, 'counted': 2})
+
+        result = DataBag.objects.filter(name__in=['alpha', 'gamma']).haggregate(
+            total=HstoreSum('data', 'qty'),
+            keys=HstoreKeyHistogram('data'),
+            colors=HstoreKeyHistogram('data', 'color'),
+        )
+        self.assertEqual(result, {
+            'total': Decimal('2'),
+            'keys': {'qty': 1, 'color': 2},
+            'colors': {'red': 1, 'blue': 1},
+        })
+
+        result = DataBag.objects.order_by('name')[1:].haggregate(
+            total=HstoreSum('data', 'qty'),
+            colors=HstoreKeyHistogram('data', 'color'),
+        )
+        self.assertEqual(result, {'total': Decimal('3'), 'colors': {'red': 1, 'blue': 1}})
+
+        result = DataBag.objects.filter(name__in=['alpha', 'beta']).distinct().haggregate(
+            counted=HstoreCountKey('data', 'qty'),
+        )
+        self.assertEqual(result, {'counted': 2})
+
+    def test_haggregate_invalid_cast(self):
+        self.assertRaises(ValueError, HstoreSum, 'data', 'qty', cast='text; DROP')
+
+    def test_materialized_key_catalog(self):
+        alpha, beta = self._create_bags()
+        install_key_catalog(DataBag, 'data')
+        try:
+            self.assertEqual(DataBag.objects.key_catalog('data', materialized=True), {'v': 2, 'v2': 2})
+
+            gamma = DataBag.objects.create(name='gamma', data={'v3': '1'})
+            DataBag.objects.filter(name='alpha').hremove('data', 'v2')
+            beta.delete()
+            self.assertEqual(DataBag.objects.key_catalog('data', materialized=True), {'v': 1, 'v3': 1})
+            self.assertEqual(DataBag.objects.key_catalog('data', materialized=True),
+                             DataBag.objects.key_catalog('data'))
+            self.assertEqual(DataBag.objects.filter(name='gamma').key_catalog('data', materialized=True),
+                             {'v3': 1})
+            self.assertEqual(DataBag.objects.order_by('name')[:1].key_catalog('data', materialized=True),
+                             {'v': 1})
+        finally:
+            uninstall_key_catalog(DataBag, 'data')
+
+    def test_sql_create_indexes(self):
+        field = DataBag._meta.get_field_by_name('data')[0]
+        connection = connections['default']
+        self.assertEqual(field.sql_create_indexes(connection), [
+            'CREATE INDEX "tests_databag_data_gin" ON "tests_databag" USING gin ("data");',
+            'CREATE INDEX "tests_databag_data_v_key" ON "tests_databag" (("data" -> \'v\'));',
+        ])
+        self.assertEqual(field.sql_drop_indexes(connection), [
+            'DROP INDEX IF EXISTS "tests_databag_data_gin";',
+            'DROP INDEX IF EXISTS "tests_databag_data_v_key";',
+        ])
+
+    def test_indexes_created(self):
+        cursor = connections['default'].cursor()
+        cursor.execute("SELECT indexname FROM pg_indexes WHERE tablename = 'tests_databag'")
+        indexes = set(row[0] for row in cursor.fetchall())
+        self.assertTrue('tests_databag_data_gin' in indexes)
+        self.assertTrue('tests_databag_data_v_key' in indexes)
+
+    def test_indexes_created_once(self):
+        from django.core.management import call_command
+        call_command('flush', interactive=False, verbosity=0)
+        call_command('flush', interactive=False, verbosity=0)
+
+        field = DataBag._meta.get_field_by_name('data')[0]
+        self.assertEqual(field.sql_create_indexes(connections['default'], exclude=['tests_databag_data_gin']), [
+            'CREATE INDEX "tests_databag_data_v_key" ON "tests_databag" (("data" -> \'v\'));',
+        ])
+
+    def test_invalid_index_type(self):
+        self.assertRaises(ValueError, DictionaryField, index_type='btree')
+
     def test_hslice_annotation(self):
         alpha, beta = self._create_bags()
         queryset = DataBag.objects.annotate_functions(sliced=HstoreSlice("data", ['v']))
@@ -276,6 +670,218 @@ class TestDictionaryField(TestCase):
         DataBag.objects.filter(name='alpha').hupdate('data', {'v2': '10', 'v3': '20'})
         self.assertEqual(DataBag.objects.get(name='alpha').data, {'v': '1', 'v2': '10', 'v3': '20'})
 
+    def test_hbatch(self):
+        alpha, beta = self._create_bags()
+        with DataBag.objects.filter(name='alpha').hbatch() as batch:
+            batch.hupdate('data', {'v3': '30', 'v4': 40})
+            batch.hremove('data', ['v', 'v4'])
+            batch.hupdate('data', {'v': '5'})
+            self.assertEqual(DataBag.objects.get(name='alpha').data, alpha.data)
+
+        self.assertEqual(DataBag.objects.get(name='alpha').data, {'v': '5', 'v2': '3', 'v3': '30'})
+        self.assertEqual(DataBag.objects.get(name='beta').data, beta.data)
+
+        def failing_batch():
+            with DataBag.objects.hbatch() as batch:
+                batch.hremove('data', 'v')
+                raise ValueError
+        self.assertRaises(ValueError, failing_batch)
+        self.assertEqual(DataBag.objects.get(name='beta').data, beta.data)
+
+        self.assertEqual(HStoreBatch(DataBag.objects.all()).execute(), 0)
+
+    def test_hincrement(self):
+        alpha, beta = self._create_bags()
+        self.assertEqual(DataBag.objects.filter(name='alpha').hincrement('data', 'v'), 1)
+        self.assertEqual(DataBag.objects.get(name='alpha').data, {'v': '2', 'v2': '3'})
+
+        DataBag.objects.all().hincrement('data', 'counter', 5)
+        DataBag.objects.filter(name='beta').hdecrement('data', 'counter', 2)
+        self.assertEqual(DataBag.objects.get(name='alpha').data['counter'], '5')
+        self.assertEqual(DataBag.objects.get(name='beta').data['counter'], '3')
+
+        DataBag.objects.filter(name='beta').hincrement('data', {'v': 10, 'v2': -4})
+        self.assertEqual(DataBag.objects.get(name='beta').data, {'v': '12', 'v2': '0', 'counter': '3'})
+
+        self.assertRaises(ValueError, DataBag.objects.hincrement, 'data', 'v', cast='text')
+
+    def test_bulk_hupdate(self):
+        alpha, beta = self._create_bags()
+        rows = DataBag.objects.bulk_hupdate('data', {
+            alpha.pk: {'v2': '10', 'v3': 20},
+            beta.pk: {'v': '5'},
+        }, batch_size=1)
+        self.assertEqual(rows, 2)
+        self.assertEqual(DataBag.objects.get(name='alpha').data, {'v': '1', 'v2': '10', 'v3': '20'})
+        self.assertEqual(DataBag.objects.get(name='beta').data, {'v': '5', 'v2': '4'})
+
+        rows = DataBag.objects.filter(name='alpha').bulk_hupdate('data', {
+            alpha.pk: {'v': '0'},
+            beta.pk: {'v': '0'},
+        })
+        self.assertEqual(rows, 1)
+        self.assertEqual(DataBag.objects.get(name='beta').data, {'v': '5', 'v2': '4'})
+
+    def test_bulk_hremove(self):
+        alpha, beta = self._create_bags()
+        rows = DataBag.objects.bulk_hremove('data', {alpha.pk: ['v2'], beta.pk: ['v', 'v2']})
+        self.assertEqual(rows, 2)
+        self.assertEqual(DataBag.objects.get(name='alpha').data, {'v': '1'})
+        self.assertEqual(DataBag.objects.get(name='beta').data, {})
+
+    def test_copy_from(self):
+        data = {'tab': 'a\tb', 'newline': 'a\nb', 'quote': 'a"b', 'backslash': 'a\\b', 'null': None, 'int': 1}
+
+        def rows():
+            yield {'name': 'alpha', 'data': data}
+            yield DataBag(name='beta', data={'v': '2'})
+            for i in range(10):
+                yield {'name': 'bag%d' % i, 'data': {'i': str(i)}}
+
+        self.assertEqual(DataBag.objects.copy_from(rows()), 12)
+        self.assertEqual(DataBag.objects.count(), 12)
+
+        expected = dict(data, int='1')
+        self.assertEqual(DataBag.objects.get(name='alpha').data, expected)
+        self.assertEqual(DataBag.objects.get(name='beta').data, {'v': '2'})
+        self.assertEqual(DataBag.objects.get(name='bag9').data, {'i': '9'})
+
+    def test_stream(self):
+        alpha, beta = self._create_bags()
+        bags = list(DataBag.objects.order_by('name').stream(chunk_size=1))
+        self.assertEqual([(bag.pk, bag.name, bag.data) for bag in bags],
+                         [(alpha.pk, 'alpha', alpha.data), (beta.pk, 'beta', beta.data)])
+        self.assertRaises(ValueError, lambda: list(DataBag.objects.defer('data').stream()))
+
+    def test_jsonl_dump_and_load(self):
+        alpha, beta = self._create_bags()
+        DataBag.objects.create(name='gamma', data={'quote': 'a"b', 'null': None})
+
+        stream = six.StringIO()
+        dump(DataBag.objects.order_by('pk'), stream, chunk_size=2)
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(json.loads(lines[0]), {
+            'model': 'tests.databag', 'pk': alpha.pk, 'fields': {'name': 'alpha', 'data': alpha.data},
+        })
+
+        expected = [(bag.pk, bag.name, bag.data) for bag in DataBag.objects.order_by('pk')]
+        DataBag.objects.all().delete()
+        stream.seek(0)
+        self.assertEqual(load(stream), 3)
+        self.assertEqual([(bag.pk, bag.name, bag.data) for bag in DataBag.objects.order_by('pk')], expected)
+
+        # the sequence is reset past the loaded primary keys
+        self.assertTrue(DataBag.objects.create(name='delta', data={}).pk > expected[-1][0])
+
+    def test_jsonl_load_keeps_auto_now(self):
+        bag = StampedBag.objects.create(name='alpha', data={'v': '1'})
+        past = datetime.datetime(2001, 2, 3, 4, 5, 6)
+        StampedBag.objects.filter(pk=bag.pk).update(created=past, modified=past)
+
+        stream = six.StringIO()
+        dump(StampedBag.objects.all(), stream)
+        StampedBag.objects.all().delete()
+        stream.seek(0)
+        self.assertEqual(load(stream), 1)
+
+        bag = StampedBag.objects.get(name='alpha')
+        self.assertEqual((bag.created, bag.modified, bag.data), (past, past, {'v': '1'}))
+
+    def test_serialize_hstore(self):
+        self.assertEqual(serialize_hstore({'a': 'x"y\\z'}), '"a"=>"x\\"y\\\\z"')
+        self.assertEqual(serialize_hstore({'b': None}), '"b"=>NULL')
+
+    def test_parse_hstore(self):
+        data = {'a': 'x"y\\z', 'b, c': '=> "d"', 'e': None, 'f\nf': ''}
+        self.assertEqual(util.parse_hstore(serialize_hstore(data)), data)
+        self.assertEqual(util.parse_hstore(''), {})
+        self.assertEqual(util.parse_hstore(None), None)
+
+    def test_fast_decoder(self):
+        from psycopg2.extras import register_hstore
+        from ..models import register_hstore_decoder, get_hstore_oids
+        alpha, beta = self._create_bags()
+        connection = connections['default']
+        connection.settings_dict['HSTORE_DECODER'] = 'fast'
+        try:
+            register_hstore_decoder(connection)
+            self.assertEqual(DataBag.objects.get(name='alpha').data, alpha.data)
+        finally:
+            del connection.settings_dict['HSTORE_DECODER']
+            # puts back the psycopg2 parser for the following tests
+            oids, array_oids = get_hstore_oids(connection)
+            register_hstore(connection.connection, unicode=sys.version_info[0] < 3,
+                            oid=oids, array_oid=array_oids)
+
+    def test_hstore_oids(self):
+        from ..models import get_hstore_oids, _hstore_oids
+        connection = connections['default']
+        _hstore_oids.clear()
+        oids, array_oids = get_hstore_oids(connection)
+        self.assertTrue(oids)
+        self.assertEqual(list(_hstore_oids.values()), [(oids, array_oids)])
+        self.assertEqual(get_hstore_oids(connection), (oids, array_oids))
+
+        connection.settings_dict['HSTORE_OIDS'] = (oids[0], array_oids[0])
+        try:
+            self.assertEqual(get_hstore_oids(connection), ((oids[0],), (array_oids[0],)))
+        finally:
+            del connection.settings_dict['HSTORE_OIDS']
+
+    def test_any_key_querying(self):
+        alpha, beta = self._create_bags()
+        DataBag.objects.create(name='gamma', data={'v3': '1'})
+
+        qs = DataBag.objects.where(HstoreExpression("data").contains_any(['v2', 'v3']))
+        self.assertEqual(qs.count(), 3)
+        qs = DataBag.objects.where(HstoreExpression("data").contains_any(['v3', 'nv']))
+        self.assertEqual(qs.get().name, 'gamma')
+        self.assertEqual(DataBag.objects.filter(data__has_any_keys=['n1', 'n2']).count(), 0)
+        self.assertRaises(ValueError, HstoreExpression("data").contains_any, 'v')
+
+    def test_contained_by_querying(self):
+        alpha, beta = self._create_bags()
+
+        qs = DataBag.objects.where(HstoreExpression("data").contained_by({'v': '1', 'v2': '3', 'v3': '5'}))
+        self.assertEqual(qs.get(), alpha)
+        self.assertEqual(DataBag.objects.get(data__contained_by={'v': '2', 'v2': 4, 'v3': '6'}), beta)
+        self.assertEqual(DataBag.objects.filter(data__contained_by={'v': '1'}).count(), 0)
+
+    def test_operator_lookups(self):
+        alpha, beta = self._create_bags()
+        self.assertEqual(DataBag.objects.get(data__contains={'v': '1'}), alpha)
+        self.assertEqual(DataBag.objects.filter(data__has_key='v').count(), 2)
+        self.assertEqual(DataBag.objects.filter(data__has_keys=['v', 'v2']).count(), 2)
+        self.assertEqual(DataBag.objects.exclude(data__contains={'v': '1'}).get(), beta)
+
+    def test_exclude_mixed_lookups(self):
+        alpha, beta = self._create_bags()
+        gamma = DataBag.objects.create(name='gamma', data={'v': '1'})
+
+        queryset = DataBag.objects.exclude(name='alpha', data__v='1').order_by('name')
+        self.assertEqual(list(queryset), [beta, gamma])
+        queryset = DataBag.objects.exclude(Q(name='alpha') | Q(name='beta'), data__v='1').order_by('name')
+        self.assertEqual(list(queryset), [beta, gamma])
+        queryset = DataBag.objects.filter(name__in=['alpha', 'beta']).exclude(name='beta', data__has_key='v')
+        self.assertEqual(list(queryset), [alpha])
+
+    def test_operator_lookups_use_gin_index(self):
+        self._create_bitfield_bags()
+        cursor = connections['default'].cursor()
+        cursor.execute('SET enable_seqscan = off')
+        try:
+            for queryset in (DataBag.objects.filter(data__contains={'b0': '1'}),
+                             DataBag.objects.filter(data__has_keys=['b0', 'b1']),
+                             DataBag.objects.filter(data__has_any_keys=['b0', 'b1']),
+                             DataBag.objects.filter(data__has_key='b2')):
+                sql, params = queryset.query.get_compiler('default').as_sql()
+                cursor.execute('EXPLAIN ' + sql, params)
+                plan = '\n'.join(row[0] for row in cursor.fetchall())
+                self.assertTrue('tests_databag_data_gin' in plan, plan)
+        finally:
+            cursor.execute('SET enable_seqscan = on')
+
     def test_key_value_subset_querying(self):
         alpha, beta = self._create_bags()
 
@@ -354,6 +960,76 @@ class TestDictionaryField(TestCase):
             self.assertEqual(b.object.data, {"a": "1", "b": "2"})
 
 
+class TestTypedDictionaryField(TestCase):
+    def setUp(self):
+        TypedBag.objects.all().delete()
+
+    def _create_bag(self):
+        return TypedBag.objects.create(name='typed', data={
+            'price': Decimal('9.99'),
+            'qty': 3,
+            'active': False,
+            'seen': datetime.datetime(2014, 1, 2, 3, 4, 5),
+            'other': '1',
+        })
+
+    def test_decode(self):
+        bag = self._create_bag()
+        bag = TypedBag.objects.get(pk=bag.pk)
+        self.assertEqual(bag.data, {
+            'price': Decimal('9.99'),
+            'qty': 3,
+            'active': False,
+            'seen': datetime.datetime(2014, 1, 2, 3, 4, 5),
+            'other': '1',
+        })
+
+    def test_encode(self):
+        field = TypedBag._meta.get_field_by_name('data')[0]
+        self.assertEqual(field.get_prep_value({'active': True, 'qty': 3, 'seen': datetime.date(2014, 1, 2)}),
+                         {'active': 'true', 'qty': '3', 'seen': '2014-01-02'})
+        self.assertEqual(field.key_cast('price'), 'numeric')
+        self.assertEqual(field.key_cast('other'), None)
+
+    def test_invalid_values_are_kept(self):
+        bag = TypedBag.objects.create(name='typed', data={'qty': 'many'})
+        self.assertEqual(TypedBag.objects.get(pk=bag.pk).data, {'qty': 'many'})
+
+    def test_key_lookups(self):
+        bag = self._create_bag()
+        TypedBag.objects.create(name='cheap', data={'price': Decimal('0.5'), 'qty': 30})
+
+        # casts from the schema
+        self.assertEqual(TypedBag.objects.get(data__price__gt=1), bag)
+        self.assertEqual(TypedBag.objects.get(data__qty__lt=10), bag)
+        self.assertEqual(TypedBag.objects.filter(data__qty__in=[3, 30]).count(), 2)
+        self.assertEqual(TypedBag.objects.get(data__seen__range=(
+            datetime.datetime(2014, 1, 1), datetime.datetime(2014, 1, 3))), bag)
+
+        # explicit casts and text lookups
+        self.assertEqual(TypedBag.objects.get(data__other__int__gte=1), bag)
+        self.assertEqual(TypedBag.objects.get(data__other='1'), bag)
+        self.assertEqual(TypedBag.objects.get(data__other__isnull=True, name='cheap').name, 'cheap')
+        self.assertEqual(TypedBag.objects.filter(data__other__startswith='1%').count(), 0)
+
+        # exclude keeps rows without the key
+        self.assertEqual(TypedBag.objects.exclude(data__qty__gt=10).get(), bag)
+        self.assertEqual(TypedBag.objects.exclude(data__other='1').get().name, 'cheap')
+
+    def test_key_expression(self):
+        bag = self._create_bag()
+        queryset = TypedBag.objects.where(HstoreExpression('data').key('qty', 'gt', 2, cast='int'))
+        self.assertEqual(queryset.get(), bag)
+        self.assertRaises(ValueError, HstoreExpression('data').key, 'qty', 'regex', 2)
+        self.assertRaises(ValueError, HstoreExpression('data').key, 'qty', 'gt', 2, cast='hstore')
+
+    def test_hpeek_hslice(self):
+        bag = self._create_bag()
+        queryset = TypedBag.objects.filter(pk=bag.pk)
+        self.assertEqual(queryset.hpeek('data', 'qty'), 3)
+        self.assertEqual(queryset.hslice('data', ['price', 'other']), {'price': Decimal('9.99'), 'other': '1'})
+
+
 class TestReferencesField(TestCase):
     def setUp(self):
         Ref.objects.all().delete()
@@ -370,6 +1046,26 @@ class TestReferencesField(TestCase):
         self.assertTrue(isinstance(bag.refs, dict))
         self.assertEqual(bag.refs, {})
 
+    def test_remove_and_merge_lazy_references(self):
+        alpha, beta, refs = self._create_bags()
+        bag = RefsBag.objects.get(pk=alpha.pk)
+        bag.refs.remove('0')
+        self.assertEqual(list(bag.refs.items()), [('1', refs[1])])
+
+        bag = RefsBag.objects.get(pk=alpha.pk)
+        bag.refs.remove('0', immediate=True)
+        bag.refs.merge({'1': refs[2]}, immediate=True)
+        self.assertEqual(bag.refs, {'1': refs[2]})
+        self.assertEqual(RefsBag.objects.get(pk=alpha.pk).refs, {'1': refs[2]})
+
+    def test_pickle_lazy_references(self):
+        alpha, beta, refs = self._create_bags()
+        bag = RefsBag.objects.get(pk=alpha.pk)
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            loaded = pickle.loads(pickle.dumps(bag.refs, protocol))
+            self.assertEqual(loaded, {'0': refs[0], '1': refs[1]})
+        self.assertEqual(copy.deepcopy(RefsBag.objects.get(pk=alpha.pk).refs), {'0': refs[0], '1': refs[1]})
+
     def test_equivalence_querying(self):
         alpha, beta, refs = self._create_bags()
         for bag in (alpha, beta):
@@ -436,3 +1132,131 @@ class TestReferencesField(TestCase):
             qs = RefsBag.objects.where(HstoreExpression("refs").contains(key))
             self.assertEqual(qs.count(), 0)
 
+
+    def test_unserialize_references(self):
+        alpha, beta, refs = self._create_bags()
+        serialized = util.serialize_references({'0': refs[0], '1': refs[1], '2': refs[2]})
+        self.assertEqual(util.unserialize_references(serialized),
+                         {'0': refs[0], '1': refs[1], '2': refs[2]})
+
+    def test_unserialize_missing_references(self):
+        alpha, beta, refs = self._create_bags()
+        serialized = util.serialize_references({'0': refs[0], '1': refs[1]})
+        refs[1].delete()
+        self.assertEqual(util.unserialize_references(serialized), {'0': refs[0], '1': None})
+
+    def test_unserialize_invalid_references(self):
+        self.assertRaises(ValueError, util.unserialize_references, {'0': 'invalid'})
+        self.assertRaises(ValueError, util.unserialize_references, {'0': 'invalid.Model:1'})
+
+
+class TestReferencesQueries(DjangoTestCase):
+    def test_references_resolved_in_bulk(self):
+        refs = [Ref.objects.create(name=str(i)) for i in range(10)]
+        bag = RefsBag.objects.create(name='bag', refs=dict((str(i), ref) for i, ref in enumerate(refs)))
+
+        instance = RefsBag.objects.get(pk=bag.pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(instance.refs, dict((str(i), ref) for i, ref in enumerate(refs)))
+
+    @skipIf(sys.version_info[0] < 3, "references are resolved on load on python 2")
+    def test_lazy_references(self):
+        refs = [Ref.objects.create(name=str(i)) for i in range(3)]
+        bag = RefsBag.objects.create(name='bag', refs={'0': refs[0], '1': refs[1], '2': refs[2]})
+
+        with self.assertNumQueries(1):
+            instance = RefsBag.objects.get(pk=bag.pk)
+            self.assertEqual(instance.name, 'bag')
+            self.assertEqual(sorted(instance.refs), ['0', '1', '2'])
+
+        with self.assertNumQueries(1):
+            self.assertEqual(instance.refs['0'], refs[0])
+            self.assertEqual(instance.refs['0'], refs[0])
+
+        with self.assertNumQueries(1):
+            self.assertEqual(sorted(instance.refs.values(), key=lambda ref: ref.pk), refs)
+
+    def test_lazy_references_copy(self):
+        refs = [Ref.objects.create(name=str(i)) for i in range(10)]
+        expected = dict((str(i), ref) for i, ref in enumerate(refs))
+        bag = RefsBag.objects.create(name='bag', refs=expected)
+
+        instance = RefsBag.objects.get(pk=bag.pk)
+        # python 2 resolves references on load
+        with self.assertNumQueries(1 if sys.version_info[0] > 2 else 0):
+            copied = dict(instance.refs)
+        self.assertEqual(copied, expected)
+        self.assertTrue(all(isinstance(ref, Ref) for ref in copied.values()))
+
+    def test_lazy_references_save(self):
+        refs = [Ref.objects.create(name=str(i)) for i in range(2)]
+        bag = RefsBag.objects.create(name='bag', refs={'0': refs[0]})
+
+        instance = RefsBag.objects.get(pk=bag.pk)
+        instance.refs['1'] = refs[1]
+        with self.assertNumQueries(1):
+            instance.save(force_update=True)
+
+        self.assertEqual(RefsBag.objects.get(pk=bag.pk).refs, {'0': refs[0], '1': refs[1]})
+
+    def test_prefetch_references(self):
+        refs = [Ref.objects.create(name=str(i)) for i in range(4)]
+        for i in range(6):
+            RefsBag.objects.create(name='bag%d' % i, refs={'0': refs[i % 4], '1': refs[(i + 1) % 4]})
+
+        with self.assertNumQueries(2):
+            bags = list(RefsBag.objects.prefetch_references('refs').order_by('name'))
+
+        for i, bag in enumerate(bags):
+            self.assertEqual(bag.refs, {'0': refs[i % 4], '1': refs[(i + 1) % 4]})
+            self.assertEqual(bag.refs.instance, bag)
+
+    def test_prefetch_references_invalid_field(self):
+        self.assertRaises(ValueError, DataBag.objects.prefetch_references, 'data')
+
+    def test_import_implementation_cache(self):
+        implementation = '%s.%s' % (Ref.__module__, Ref.__name__)
+        self.assertTrue(util.import_implementation(implementation) is Ref)
+        self.assertTrue(util._implementations[implementation] is Ref)
+
+    @override_settings(DJORM_HSTORE_REFERENCES_CACHE={'MAX_ENTRIES': 10, 'TIMEOUT': 60})
+    def test_references_cache(self):
+        ref = Ref.objects.create(name='config')
+        reference = util.identify_instance(ref)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(util.acquire_reference(reference), ref)
+        with self.assertNumQueries(0):
+            self.assertEqual(util.acquire_reference(reference).name, 'config')
+
+        ref.name = 'changed'
+        ref.save()
+        with self.assertNumQueries(1):
+            self.assertEqual(util.acquire_reference(reference).name, 'changed')
+
+    @override_settings(DJORM_HSTORE_REFERENCES_CACHE={'MAX_ENTRIES': 10, 'TIMEOUT': 60})
+    def test_references_cache_invalidated_without_resolving(self):
+        ref = Ref.objects.create(name='config')
+        reference = util.identify_instance(ref)
+        # as cached by another process sharing the cache
+        cache = get_references_cache()
+        cache.set_many({reference: ref})
+
+        ref.name = 'changed'
+        ref.save()
+        self.assertEqual(cache.get_many([reference]), {})
+
+    def test_locmem_references_cache(self):
+        cache = LocMemReferenceCache(max_entries=2, timeout=60)
+        cache.set_many({'a': 1, 'b': 2})
+        self.assertEqual(cache.get_many(['a']), {'a': 1})
+        cache.set_many({'c': 3})
+        self.assertEqual(cache.get_many(['a', 'b', 'c']), {'a': 1, 'c': 3})
+
+        cache.set_many({'d': {'name': 'config'}})
+        cache.get_many(['d'])['d']['name'] = 'changed'
+        self.assertEqual(cache.get_many(['d']), {'d': {'name': 'config'}})
+
+        cache = LocMemReferenceCache(timeout=-1)
+        cache.set_many({'a': 1})
+        self.assertEqual(cache.get_many(['a']), {})
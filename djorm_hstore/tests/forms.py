@@ -1,9 +1,14 @@
 
 from django.forms import ModelForm
 
-from .models import DataBag
+from .models import DataBag, DataBagDelta
 
 
 class DataBagForm(ModelForm):
     class Meta:
         model = DataBag
+
+
+class DataBagDeltaForm(ModelForm):
+    class Meta:
+        model = DataBagDelta
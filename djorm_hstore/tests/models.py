@@ -1,4 +1,7 @@
 
+import datetime
+from decimal import Decimal
+
 from django.db import models
 
 from ..fields import DictionaryField, ReferencesField
@@ -17,7 +20,7 @@ class Ref(models.Model):
 
 class DataBag(models.Model):
     name = models.CharField(max_length=32)
-    data = DictionaryField(db_index=True)
+    data = DictionaryField(index_type='gin', key_indexes=['v'])
 
     objects = HStoreManager()
 
@@ -43,6 +46,55 @@ class DataBagNullable(models.Model):
         return self.name
 
 
+class DataBagDelta(models.Model):
+    name = models.CharField(max_length=32)
+    data = DictionaryField(delta_save=True)
+
+    objects = HStoreManager()
+
+    _options = {
+        'manager': False
+    }
+
+    def __unicode__(self):
+        return self.name
+
+
+class StampedBag(models.Model):
+    name = models.CharField(max_length=32)
+    data = DictionaryField()
+    created = models.DateTimeField(auto_now_add=True)
+    modified = models.DateTimeField(auto_now=True)
+
+    objects = HStoreManager()
+
+    _options = {
+        'manager': False
+    }
+
+    def __unicode__(self):
+        return self.name
+
+
+class TypedBag(models.Model):
+    name = models.CharField(max_length=32)
+    data = DictionaryField(schema={
+        'price': Decimal,
+        'qty': int,
+        'active': bool,
+        'seen': datetime.datetime,
+    })
+
+    objects = HStoreManager()
+
+    _options = {
+        'manager': False
+    }
+
+    def __unicode__(self):
+        return self.name
+
+
 class RefsBag(models.Model):
     name = models.CharField(max_length=32)
     refs = ReferencesField(db_index=True)
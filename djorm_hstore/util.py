@@ -1,8 +1,16 @@
 # -*- coding: utf-8 -*-
 
-from django.core.exceptions import ObjectDoesNotExist
+from django.db.models import signals
 
+import re
 import sys
+import json
+import datetime
+from decimal import Decimal
+
+from django.utils import dateparse
+
+from .cache import get_references_cache
 
 if sys.version_info[0] == 3:
     string_type = str
@@ -15,16 +23,270 @@ else:
     basestring = (str, unicode)
 
 
-def acquire_reference(reference):
-    try:
-        implementation, identifier = reference.split(':')
-        module, sep, attr = implementation.rpartition('.')
-        implementation = getattr(__import__(module, fromlist=(attr,)), attr)
-        return implementation.objects.get(pk=identifier)
-    except ObjectDoesNotExist:
+_prepared_types = frozenset([string_type, bytes_type, type(None)])
+
+
+def prepare_hstore(data, encoders=None):
+    """
+    Returns a copy of the dictionary with all values but None converted
+    to text, leaving the given dictionary untouched. `encoders` maps keys
+    to the functions used to convert their values.
+    """
+    prepared = dict(data)
+    for key, value in data.items():
+        if type(value) in _prepared_types:
+            continue
+        if encoders and key in encoders:
+            prepared[key] = encoders[key](value)
+        elif not isinstance(value, (string_type, bytes_type)):
+            prepared[key] = string_type(value)
+    return prepared
+
+
+_hstore_pair = re.compile(r'"([^"\\]*(?:\\.[^"\\]*)*)"\s*=>\s*(NULL|"[^"\\]*(?:\\.[^"\\]*)*")')
+_hstore_escape = re.compile(r'\\(.)')
+
+
+def parse_hstore(value):
+    """
+    Parses the text representation of an hstore, as sent by the server,
+    into a dictionary. Unlike the psycopg2 parser it doesn't validate the
+    text between the pairs, and only unescapes the strings which contain
+    backslashes.
+    """
+    if value is None:
         return None
-    except Exception:
-        raise ValueError
+
+    result = {}
+    for key, val in _hstore_pair.findall(value):
+        if '\\' in key:
+            key = _hstore_escape.sub(r'\1', key)
+        if val == 'NULL':
+            val = None
+        else:
+            val = val[1:-1]
+            if '\\' in val:
+                val = _hstore_escape.sub(r'\1', val)
+        result[key] = val
+    return result
+
+
+def _parse_bool(value):
+    value = value.lower()
+    if value in ('true', 't', '1', 'yes', 'y', 'on'):
+        return True
+    if value in ('false', 'f', '0', 'no', 'n', 'off'):
+        return False
+    raise ValueError(value)
+
+
+def _parser(parse):
+    def parser(value):
+        result = parse(value)
+        if result is None:
+            raise ValueError(value)
+        return result
+    return parser
+
+
+def _encode_bool(value):
+    return 'true' if value else 'false'
+
+
+def _encode_isoformat(value):
+    return value.isoformat()
+
+
+# python type: (decoder, encoder, postgresql type)
+SCHEMA_TYPES = {
+    string_type: (string_type, string_type, 'text'),
+    int: (int, string_type, 'bigint'),
+    float: (float, repr, 'double precision'),
+    Decimal: (Decimal, string_type, 'numeric'),
+    bool: (_parse_bool, _encode_bool, 'boolean'),
+    datetime.datetime: (_parser(dateparse.parse_datetime), _encode_isoformat, 'timestamptz'),
+    datetime.date: (_parser(dateparse.parse_date), _encode_isoformat, 'date'),
+    datetime.time: (_parser(dateparse.parse_time), _encode_isoformat, 'time'),
+}
+
+if sys.version_info[0] < 3:
+    SCHEMA_TYPES[long] = (long, string_type, 'bigint')
+
+
+def compile_schema(schema):
+    """
+    Returns the decoders, encoders and postgresql types of the keys of
+    a {key: python type} schema. Types not in SCHEMA_TYPES are used as
+    decoders and encoded as text.
+    """
+    decoders, encoders, casts = {}, {}, {}
+    for key, python_type in schema.items():
+        if python_type in SCHEMA_TYPES:
+            decoders[key], encoders[key], casts[key] = SCHEMA_TYPES[python_type]
+        elif callable(python_type):
+            decoders[key], encoders[key] = python_type, string_type
+        else:
+            raise ValueError("Invalid schema type for key %s" % key)
+    return decoders, encoders, casts
+
+
+def decode_hstore(data, decoders):
+    """
+    Returns a copy of the dictionary with the text values of the keys in
+    `decoders` converted. Values which can't be converted are kept.
+    """
+    decoded = None
+    for key, decoder in decoders.items():
+        value = data.get(key)
+        if not isinstance(value, basestring):
+            continue
+        try:
+            value = decoder(value)
+        except (TypeError, ValueError, ArithmeticError):
+            continue
+        if decoded is None:
+            decoded = dict(data)
+        decoded[key] = value
+    return data if decoded is None else decoded
+
+
+class HStoreDelta(dict):
+    """
+    Pairs to set and keys to remove from a dictionary, as submitted by a
+    paged KeyValueWidget which only renders part of the dictionary.
+    """
+    def __init__(self, updates=None, removed=()):
+        super(HStoreDelta, self).__init__(updates or {})
+        self.removed = set(removed) - set(self)
+
+    # a delta which only removes keys is not empty: forms must not
+    # reject it as a missing value
+    def __bool__(self):
+        return bool(len(self) or self.removed)
+    __nonzero__ = __bool__
+
+    def __eq__(self, other):
+        if isinstance(other, HStoreDelta):
+            return dict.__eq__(self, other) and self.removed == other.removed
+        if self.removed:
+            return False
+        return dict.__eq__(self, other)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def apply(self, data):
+        """
+        Merges the changes into the given dictionary, in place.
+        """
+        for key in self.removed:
+            data.pop(key, None)
+        data.update(self)
+        return data
+
+    def changes(self, data):
+        """
+        Tells whether applying the delta would change the dictionary.
+        """
+        return any(key in data for key in self.removed) or \
+            any(key not in data or data[key] != value for key, value in self.items())
+
+
+def _load_dictionary(value):
+    if isinstance(value, basestring):
+        value = json.loads(value) if value else None
+    return {} if value is None else value
+
+
+def dictionary_changed(initial, data):
+    """
+    Tells whether the data submitted for a dictionary differs from its
+    initial value, comparing them structurally. Both can be dictionaries
+    or their JSON representations.
+    """
+    try:
+        initial, data = _load_dictionary(initial), _load_dictionary(data)
+    except ValueError:
+        return True
+    if isinstance(data, HStoreDelta):
+        return data.changes(initial)
+    return initial != data
+
+
+_implementations = {}
+
+
+def import_implementation(implementation):
+    """
+    Returns the class for the specified dotted path, caching it so the
+    import machinery is only involved on first use.
+    """
+    try:
+        return _implementations[implementation]
+    except KeyError:
+        pass
+
+    module, sep, attr = implementation.rpartition('.')
+    model = getattr(__import__(module, fromlist=(attr,)), attr)
+    _implementations[implementation] = model
+    return model
+
+
+def acquire_reference(reference):
+    return acquire_references({None: reference})[None]
+
+
+def acquire_references(references):
+    """
+    Resolves a mapping of keys to serialized references, issuing a
+    single query per referenced model instead of one per key.
+    Missing instances are resolved to None.
+    """
+    cache = get_references_cache()
+    cached = cache.get_many(set(references.values())) if cache is not None else {}
+
+    grouped, refs = {}, {}
+    for key, reference in references.items():
+        if reference in cached:
+            refs[key] = cached[reference]
+            continue
+        try:
+            implementation, identifier = reference.split(':')
+        except Exception:
+            raise ValueError
+        grouped.setdefault(implementation, {})[key] = identifier
+
+    for implementation, identifiers in grouped.items():
+        try:
+            model = import_implementation(implementation)
+            queryset = model.objects.filter(pk__in=set(identifiers.values()))
+            instances = dict((string_type(instance.pk), instance) for instance in queryset)
+        except Exception:
+            raise ValueError
+
+        for key, identifier in identifiers.items():
+            refs[key] = instances.get(identifier)
+
+        if cache is not None and instances:
+            cache.set_many(dict(('%s:%s' % (implementation, identifier), instance)
+                                for identifier, instance in instances.items()))
+    return refs
+
+
+def invalidate_reference(sender, instance, **kwargs):
+    """
+    Drops saved or deleted instances from the references cache. Any
+    instance may have been cached by another process sharing the cache.
+    """
+    cache = get_references_cache()
+    if cache is not None:
+        cache.delete(identify_instance(instance))
+
+signals.post_save.connect(invalidate_reference)
+signals.post_delete.connect(invalidate_reference)
 
 
 def identify_instance(instance):
@@ -44,11 +306,12 @@ def serialize_references(references):
 
 
 def unserialize_references(references):
-    refs = {}
+    refs, pending = {}, {}
     for key, reference in references.items():
         if isinstance(reference, basestring):
-            refs[key] = acquire_reference(reference)
+            pending[key] = reference
         else:
             refs[key] = reference
     else:
+        refs.update(acquire_references(pending))
         return refs
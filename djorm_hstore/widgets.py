@@ -2,12 +2,16 @@
 
 import json
 
+import django
 from django import forms
 from django.forms import widgets
 from django.contrib.admin.templatetags.admin_static import static
+from django.utils.html import escape
 from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext as _
 
+from . import util
+
 
 class KeyValueWidget(widgets.MultiWidget):
     input_widget_class = widgets.TextInput
@@ -17,14 +21,22 @@ class KeyValueWidget(widgets.MultiWidget):
     add_button_template = '<a href="javascript:void(0)" class="add_keyvaluewidget">' +\
                           '<img src="%(icon_url)s" width="10" height="10"> %(name)s</a>'
     remove_button_template = '<div class="field-box"><a class="inline-deletelink" href="javascript:void(0)">%s</a></div>'
+    paging_template = '<input type="hidden" name="%(name)s_partial" value="1">' +\
+                      '<input type="hidden" name="%(name)s_removed" value="%(removed)s" class="removed_keyvaluewidget">' +\
+                      '<div class="field-box"><p class="help">%(count)s</p></div>'
+    search_template = '<div class="field-box"><input type="text" class="vTextField search_keyvaluewidget" ' +\
+                      'data-search-url="%(url)s" placeholder="%(placeholder)s"></div>'
+    original_template = '<input type="hidden" name="%(name)s" value="%(key)s" class="original_keyvaluewidget">'
 
     @property
     def media(self):
         return forms.Media(js=[static("djorm_hstore/js/djorm_hstore.js")])
 
-    def __init__(self, attrs=None, key_attrs=None, value_attrs=None):
+    def __init__(self, attrs=None, key_attrs=None, value_attrs=None, page_size=None, search_url=None):
         self.key_attrs = key_attrs or {}
         self.value_attrs = value_attrs or {}
+        self.page_size = page_size
+        self.search_url = search_url
         attrs = attrs or {}
         attrs.setdefault('class', 'vTextField')
         self.attrs = attrs
@@ -35,7 +47,7 @@ class KeyValueWidget(widgets.MultiWidget):
         final_attrs = self.build_attrs(attrs)
         main_id = self.id_for_label(final_attrs.get('id', None))
         if value:
-            values = json.loads(value).items()
+            values = value if isinstance(value, dict) else json.loads(value)
             empty_row = ''.join([  # row for cloning in js
                 self.make_input_widget('key', name, '', main_id, '', final_attrs),
                 self.make_input_widget('value', name, '', main_id, '', final_attrs),
@@ -47,15 +59,44 @@ class KeyValueWidget(widgets.MultiWidget):
                     empty_row
                 )
             ]
-            for i, (key, val) in enumerate(values, start=1):
-                output.extend(self.row_template % ('', ''.join([
+
+            if self.page_size is None:
+                pairs = values.items()
+            else:
+                pairs = sorted(values.items())[:self.page_size]
+                output.append(self.make_paging(name, main_id, len(pairs), len(values),
+                                               getattr(values, 'removed', ())))
+
+            for i, (key, val) in enumerate(pairs, start=1):
+                output.append(self.row_template % ('', ''.join([
                     self.make_input_widget('key', name, key, main_id, i, final_attrs),
                     self.make_input_widget('value', name, val, main_id, i, final_attrs),
                     self.make_del_link(name, main_id, i),
+                    self.make_original_input(name, key, i) if self.page_size is not None else '',
                 ])))
             return mark_safe(self.format_output(name, main_id, output))
         return ''
 
+    def make_paging(self, name, main_id, shown, total, removed):
+        """
+        Renders the hidden inputs which make the submitted pairs a delta
+        and, if a search url is set, the box to find pairs not shown.
+        """
+        output = self.paging_template % {
+            'name': name,
+            'removed': escape(json.dumps(sorted(removed))),
+            'count': _('Showing %(shown)s of %(total)s pairs') % {'shown': shown, 'total': total},
+        }
+        if self.search_url is not None:
+            output += self.search_template % {
+                'url': escape(self.search_url),
+                'placeholder': _('Search keys'),
+            }
+        return self.row_template % ('', output)
+
+    def make_original_input(self, name, key, index):
+        return self.original_template % {'name': '%s_original_%s' % (name, index), 'key': escape(key)}
+
     def make_input_widget(self, widget_type, name, value, main_id, index, attrs):
         id_ = '%s_%s_%s' % (main_id, widget_type, index)
         attrs = dict(attrs, id=id_, name="%s_%s_%s" % (name, widget_type, index))
@@ -78,14 +119,29 @@ class KeyValueWidget(widgets.MultiWidget):
         return html
 
     def value_from_datadict(self, data, files, name):
-        value = {}
+        value, removed = {}, set()
         for key_fieldname in sorted([i for i in data if i.startswith(name + "_key_")]):
             key = data.get(key_fieldname, '')
+            original = data.get(key_fieldname.replace('_key_', '_original_'), '')
+            if original and original != key:
+                removed.add(original)
             if not key:
                 continue
             val = data.get(key_fieldname.replace('_key_', '_value_'), '')
             value[key] = val
-        return json.dumps(value)
+
+        if data.get(name + '_partial'):
+            try:
+                removed.update(json.loads(data.get(name + '_removed') or '[]'))
+            except ValueError:
+                pass
+            return util.HStoreDelta(value, removed)
+        return value
 
     def decompress(self, value):
-        return json.loads(value).items()
+        return (value if isinstance(value, dict) else json.loads(value)).items()
+
+    if django.VERSION < (1, 6):
+        # Django < 1.6 asks widgets, not fields, whether the data changed
+        def _has_changed(self, initial, data):
+            return util.dictionary_changed(initial, data)
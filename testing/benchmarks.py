@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the hstore hot paths, run against a local PostgreSQL
+database configured in settings.py (a test database is created and
+destroyed around the run).
+
+Usage::
+
+    python benchmarks.py [--output results.json] [--rows 10000] [--width 2000]
+
+Results are written as JSON, so that runs of different releases can
+be compared.
+"""
+
+import os, sys
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "settings")
+sys.path.insert(0, '..')
+
+import gc
+import json
+import time
+import platform
+from optparse import OptionParser
+
+import django
+from django.db import connection
+
+
+def measure(func, number, repeat=3):
+    timings = []
+    for i in range(repeat):
+        gc.collect()
+        start = time.time()
+        for j in range(number):
+            func()
+        timings.append((time.time() - start) / number)
+    return {
+        'number': number,
+        'repeat': repeat,
+        'best': min(timings),
+        'mean': sum(timings) / len(timings),
+    }
+
+
+def run(rows, width):
+    from djorm_hstore.expressions import HstoreExpression
+    from djorm_hstore.tests.models import DataBag, DataBagNullable, Ref, RefsBag
+    from djorm_hstore.widgets import KeyValueWidget
+    from djorm_hstore.bulk import serialize_hstore
+    from djorm_hstore import util
+    from psycopg2.extras import HstoreAdapter
+
+    wide = dict(('key%d' % i, i) for i in range(width))
+    wide_json = json.dumps(dict((key, str(value)) for key, value in wide.items()))
+    wide_text = serialize_hstore(wide)
+    data_field = DataBag._meta.get_field_by_name('data')[0]
+
+    refs = [Ref.objects.create(name=str(i)) for i in range(100)]
+    serialized = util.serialize_references(dict((str(i), ref) for i, ref in enumerate(refs)))
+
+    def rows_for(i):
+        return {'name': 'bag%d' % i, 'data': {'color': str(i % 10), 'size': str(i % 7), 'id': str(i)}}
+
+    DataBag.objects.copy_from(rows_for(i) for i in range(rows))
+    DataBagNullable.objects.copy_from(rows_for(i) for i in range(rows))
+    cursor = connection.cursor()
+    cursor.execute('ANALYZE')
+
+    def contains(model):
+        def query():
+            len(model.objects.where(HstoreExpression('data').contains({'color': '3', 'size': '5'})))
+        return query
+
+    widget = KeyValueWidget()
+    results = {
+        'get_prep_value.wide_dict': measure(lambda: data_field.get_prep_value(dict(wide)), 50),
+        'decoder.psycopg2.wide_hstore': measure(lambda: HstoreAdapter.parse(wide_text, None), 50),
+        'decoder.fast.wide_hstore': measure(lambda: util.parse_hstore(wide_text), 50),
+        'to_python.json_string': measure(lambda: data_field.to_python(wide_json), 50),
+        'references.unserialize': measure(lambda: util.unserialize_references(serialized), 20),
+        'references.load_and_resolve': measure(
+            lambda: RefsBag.objects.create(name='refs', refs=serialized).refs.resolve(), 20),
+        'hupdate': measure(lambda: DataBag.objects.filter(name='bag1').hupdate('data', {'extra': '1'}), 50),
+        'hremove': measure(lambda: DataBag.objects.filter(name='bag1').hremove('data', ['extra']), 50),
+        'contains.gin_index': measure(contains(DataBag), 10),
+        'contains.btree_index': measure(contains(DataBagNullable), 10),
+        'widget.render.wide_dict': measure(lambda: widget.render('data', wide_json), 10),
+    }
+
+    return {
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'rows': rows,
+        'width': width,
+        'results': results,
+    }
+
+
+if __name__ == "__main__":
+    parser = OptionParser()
+    parser.add_option('--output', dest='output', help='write the results to this file')
+    parser.add_option('--rows', dest='rows', type='int', default=10000)
+    parser.add_option('--width', dest='width', type='int', default=2000)
+    options, args = parser.parse_args()
+
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0)
+    try:
+        report = json.dumps(run(options.rows, options.width), indent=2, sort_keys=True)
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    if options.output:
+        with open(options.output, 'w') as output:
+            output.write(report)
+    else:
+        print(report)